@@ -0,0 +1,133 @@
+"""Local stand-ins for the OpenAI and LINE APIs used by the benchmarks."""
+import asyncio
+import hashlib
+import socket
+import threading
+import time
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from langchain_core.embeddings import Embeddings
+
+
+class FakeEmbeddings(Embeddings):
+    """Deterministic unit vectors derived from character trigrams of the text.
+
+    Texts that share wording get similar vectors, which keeps near-duplicate
+    detection and retrieval behaving roughly like real embeddings.
+    """
+
+    def __init__(self, dim=1536, latency=0.0):
+        self.dim = dim
+        self.latency = latency
+        self.model = f"fake-{dim}"
+        self.calls = 0
+
+    def _embed(self, text):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        padded = f"  {text} "
+        for i in range(len(padded) - 2):
+            digest = hashlib.blake2b(padded[i:i + 3].encode("utf-8"), digest_size=8).digest()
+            slot = int.from_bytes(digest[:4], "little") % self.dim
+            vector[slot] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def fake_openai_app(latency=0.0):
+    """Chat-completions endpoint answering with canned persona and extraction replies."""
+    app = FastAPI()
+    app.state.calls = 0
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.calls += 1
+        if latency:
+            await asyncio.sleep(latency)
+        system = body["messages"][0]["content"]
+        if "筆記小幫手" in system:
+            content = f"- 第 {app.state.calls} 次整理的重點\n- 大迎新在 9/4 晚上"
+        else:
+            content = "主啊救我～但我有看到你的訊息了"
+        return {
+            "id": f"chatcmpl-{app.state.calls}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4o"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+
+    return app
+
+
+def fake_line_app(latency=0.0):
+    """Messaging API endpoints used by the bot; records when each reply arrives."""
+    app = FastAPI()
+    app.state.replies = {}  # reply token or push target -> arrival times
+    app.state.pushes = 0
+    app.state.profile_calls = 0
+
+    @app.post("/v2/bot/message/reply")
+    async def reply(request: Request):
+        body = await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        app.state.replies.setdefault(body["replyToken"], []).append(time.perf_counter())
+        return {"sentMessages": [{"id": "1", "quoteToken": "q"}]}
+
+    @app.post("/v2/bot/message/push")
+    async def push(request: Request):
+        body = await request.json()
+        if latency:
+            await asyncio.sleep(latency)
+        app.state.pushes += 1
+        app.state.replies.setdefault(body["to"], []).append(time.perf_counter())
+        return {"sentMessages": [{"id": "1", "quoteToken": "q"}]}
+
+    @app.get("/v2/bot/group/{group_id}/member/{user_id}")
+    async def member_profile(group_id: str, user_id: str):
+        app.state.profile_calls += 1
+        if latency:
+            await asyncio.sleep(latency)
+        return {"displayName": f"新生{user_id[-3:]}", "userId": user_id}
+
+    return app
+
+
+class BackgroundServer:
+    """Serve an ASGI app with uvicorn on a free localhost port in a daemon thread."""
+
+    def __init__(self, app):
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            self.port = sock.getsockname()[1]
+        self.app = app
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning"))
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        while not self._server.started:
+            time.sleep(0.01)
+        return self
+
+    def __exit__(self, *exc):
+        self._server.should_exit = True
+        self._thread.join()
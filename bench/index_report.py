@@ -0,0 +1,153 @@
+"""Recall vs. latency report for the FAISS index types.
+
+Builds every index type over the same vectors, then measures recall@k
+against exact (flat) search, single-query latency, build time and size,
+sweeping the search-time knobs (``nprobe`` for IVF, ``efSearch`` for HNSW).
+Vectors come from a stored memory or from synthetic clustered unit vectors.
+
+    python -m bench.index_report --documents 20000 --dim 1536
+    python -m bench.index_report --memory-dir memory --group Cxxxx --memory-type knowledge
+    python -m bench.index_report --types flat,hnsw,ivf_pq --json index_report.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import faiss
+import numpy as np
+
+from bench.run import percentiles
+from index_types import INDEX_TYPES, all_vectors, build_index, bytes_per_vector, min_training_points, tune
+
+NPROBES = (1, 4, 16, 64)
+EF_SEARCHES = (16, 64, 256)
+
+
+def synthetic_vectors(n, dim, clusters=200, spread=0.35, seed=0):
+    """Unit vectors around random topic centres, roughly how sentence embeddings cluster."""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    centres /= np.linalg.norm(centres, axis=1, keepdims=True)
+    noise = rng.standard_normal((n, dim)).astype(np.float32) * spread / np.sqrt(dim)
+    vectors = centres[rng.integers(0, clusters, n)] + noise
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def stored_vectors(memory_dir, group_id, memory_type):
+    """Vectors of the published snapshot plus the document log, read without loading the app."""
+    from state_store import SQLiteStateStore
+
+    path = os.path.join(memory_dir, group_id, memory_type)
+    folder, seq = path, 0
+    if os.path.exists(os.path.join(path, "CURRENT")):
+        with open(os.path.join(path, "CURRENT"), encoding="utf-8") as f:
+            current = json.load(f)
+        folder, seq = os.path.join(path, current["snapshot"]), current["seq"]
+    parts = []
+    if os.path.exists(os.path.join(folder, "index.faiss")):
+        parts.append(all_vectors(faiss.read_index(os.path.join(folder, "index.faiss"))))
+    records = SQLiteStateStore(os.path.join(memory_dir, "state.db")).documents_after(group_id, memory_type, seq)
+    if records:
+        parts.append(np.asarray([r["embedding"] for r in records], dtype=np.float32))
+    if not parts:
+        raise SystemExit(f"No stored vectors for {group_id}/{memory_type} in {memory_dir}")
+    return np.concatenate(parts)
+
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(f) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def measure(index, queries, truth, k):
+    latencies = []
+    found = []
+    for query in queries:
+        t0 = time.perf_counter()
+        _, ids = index.search(query[None, :], k)
+        latencies.append(time.perf_counter() - t0)
+        found.append(ids[0])
+    return {"recall": round(recall_at_k(found, truth), 4), **percentiles(latencies)}
+
+
+def settings(index_type):
+    if index_type.startswith("ivf"):
+        return [{"nprobe": p} for p in NPROBES]
+    if index_type.startswith("hnsw"):
+        return [{"ef_search": ef} for ef in EF_SEARCHES]
+    return [{}]
+
+
+def report(vectors, queries, types, k):
+    exact = faiss.IndexFlatL2(vectors.shape[1])
+    exact.add(vectors)
+    _, truth = exact.search(queries, k)
+
+    rows = []
+    for index_type in types:
+        if len(vectors) < min_training_points(index_type):
+            print(f"[bench] {index_type}: needs {min_training_points(index_type)} vectors, skipped", file=sys.stderr)
+            continue
+        t0 = time.perf_counter()
+        index = build_index(index_type, vectors)
+        build_seconds = time.perf_counter() - t0
+        for params in settings(index_type):
+            tune(index, **params)
+            row = {
+                "type": index_type,
+                **params,
+                "build_seconds": round(build_seconds, 3),
+                "bytes_per_vector": bytes_per_vector(index),
+                "index_mb": round(len(faiss.serialize_index(index)) / 2**20, 2),
+                **measure(index, queries, truth, k),
+            }
+            rows.append(row)
+            print(f"[bench] {row}", file=sys.stderr)
+    return rows
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--memory-dir", help="read vectors from this memory directory instead of generating them")
+    parser.add_argument("--group", help="group id to read (with --memory-dir)")
+    parser.add_argument("--memory-type", default="knowledge", choices=("knowledge", "dialogue"))
+    parser.add_argument("--documents", type=int, default=20000, help="synthetic vector count")
+    parser.add_argument("--dim", type=int, default=1536, help="synthetic vector width")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=3)
+    parser.add_argument("--types", default=",".join(INDEX_TYPES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    if args.memory_dir:
+        if not args.group:
+            parser.error("--group is required with --memory-dir")
+        vectors = stored_vectors(args.memory_dir, args.group, args.memory_type)
+        rng = np.random.default_rng(args.seed)
+        # Perturbed stored vectors stand in for questions about stored content.
+        picks = vectors[rng.integers(0, len(vectors), args.queries)]
+        queries = picks + rng.standard_normal(picks.shape).astype(np.float32) * 0.1 / np.sqrt(vectors.shape[1])
+    else:
+        sample = synthetic_vectors(args.documents + args.queries, args.dim, seed=args.seed)
+        vectors, queries = sample[:args.documents], sample[args.documents:]
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    types = [t for t in args.types.split(",") if t]
+    result = {
+        "documents": len(vectors),
+        "dim": int(vectors.shape[1]),
+        "queries": len(queries),
+        "k": args.k,
+        "results": report(vectors, queries, types, args.k),
+    }
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
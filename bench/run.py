@@ -0,0 +1,307 @@
+"""Offline benchmarks for the bot.
+
+Runs /callback, /upload, /dump and MemoryManager against local fakes: a
+chat-completions server and a LINE Messaging API server with configurable
+latency, plus deterministic in-process embeddings. No credentials or network
+access are needed.
+
+    python -m bench.run                                  # everything, synthetic trace
+    python -m bench.run --trace bench/traces/sample.jsonl --only webhook
+    python -m bench.run --sizes 1000,10000,50000 --only memory --json report.json
+
+A trace is JSONL with one message per line:
+
+    {"group_id": "Cgroup1", "user_id": "U001", "text": "大迎新幾點？", "mention_bot": true, "delay": 0.2}
+
+``mention_bot`` and ``mentions`` (a list of user ids) are optional; ``delay``
+is the gap in seconds before the message and is scaled by ``--speed``.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+
+from bench.fakes import BackgroundServer, FakeEmbeddings, fake_line_app, fake_openai_app
+
+CHANNEL_SECRET = "bench-secret"
+BOT_USER_ID = "Ubench0bot"
+BOT_MENTION = "@鄭玟欣真溫馨"
+
+SAMPLE_LINES = [
+    "9/4 大迎新 18:30 在新生教學館 101",
+    "宿舍申請 8/20 截止，請到學生住宿服務網登記",
+    "新生健康檢查連結請看記事本",
+    "週四晚上大聚會，結束後一起吃飯",
+    "小組聚會在活大二樓，週二中午",
+    "光鹽食物地圖：活大滷味有素的",
+]
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(samples):
+    if not samples:
+        return {"p50_ms": None, "p99_ms": None}
+    return {
+        "p50_ms": round(float(np.percentile(samples, 50)) * 1000, 2),
+        "p99_ms": round(float(np.percentile(samples, 99)) * 1000, 2),
+    }
+
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def synthetic_trace(messages, groups, mention_rate=0.2, seed=0):
+    rng = random.Random(seed)
+    trace = []
+    for i in range(messages):
+        mention_bot = rng.random() < mention_rate
+        # Questions to the bot repeat, as freshman questions do; chatter does not.
+        text = f"{rng.choice(SAMPLE_LINES)}？" if mention_bot else f"{rng.choice(SAMPLE_LINES)}？（第 {i} 則）"
+        trace.append({
+            "group_id": f"Cbench{rng.randrange(groups):03d}",
+            "user_id": f"U{rng.randrange(200):03d}",
+            "text": text,
+            "mention_bot": mention_bot,
+            "delay": 0.0,
+        })
+    return trace
+
+
+def webhook_body(record):
+    mentionees = []
+    text = record["text"]
+    if record.get("mention_bot"):
+        mentionees.append({"index": 0, "length": len(BOT_MENTION), "type": "user", "userId": BOT_USER_ID, "isSelf": True})
+        text = f"{BOT_MENTION} {text}"
+    for user_id in record.get("mentions", []):
+        mentionees.append({"index": len(text) + 1, "length": len(user_id) + 1, "type": "user", "userId": user_id, "isSelf": False})
+        text = f"{text} @{user_id}"
+    message = {"type": "text", "id": uuid.uuid4().hex, "quoteToken": uuid.uuid4().hex, "text": text}
+    if mentionees:
+        message["mention"] = {"mentionees": mentionees}
+    reply_token = uuid.uuid4().hex
+    event = {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "group", "groupId": record["group_id"], "userId": record["user_id"]},
+        "webhookEventId": uuid.uuid4().hex,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+        "message": message,
+    }
+    return json.dumps({"destination": BOT_USER_ID, "events": [event]}, ensure_ascii=False).encode("utf-8"), reply_token
+
+
+def sign(body):
+    digest = hmac.new(CHANNEL_SECRET.encode("utf-8"), body, hashlib.sha256).digest()
+    return base64.b64encode(digest).decode("ascii")
+
+
+async def bench_webhook(main, client, line_app, trace, speed):
+    latencies = []
+    sent_at = {}
+    started = time.perf_counter()
+    for record in trace:
+        if record.get("delay") and speed:
+            await asyncio.sleep(record["delay"] / speed)
+        body, reply_token = webhook_body(record)
+        t0 = time.perf_counter()
+        response = await client.post("/callback", content=body, headers={"X-Line-Signature": sign(body)})
+        latencies.append(time.perf_counter() - t0)
+        response.raise_for_status()
+        sent_at[reply_token] = t0
+    while main.dispatcher.stats()["pending"]:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    reply_latencies = [line_app.state.replies[token][0] - t0
+                       for token, t0 in sent_at.items() if token in line_app.state.replies]
+    return {
+        "messages": len(trace),
+        "groups": len({r["group_id"] for r in trace}),
+        "messages_per_sec": round(len(trace) / elapsed, 1),
+        "webhook_latency": percentiles(latencies),
+        "reply_latency": percentiles(reply_latencies),
+        "replies": len(reply_latencies),
+        "pushes": line_app.state.pushes,
+        "profile_calls": line_app.state.profile_calls,
+        "stats": (await client.get("/stats")).json(),
+        "rss_mb": round(rss_mb(), 1),
+    }
+
+
+async def bench_upload_and_dump(client, lines):
+    group_id = "Cbenchupload"
+    text = "\n".join(f"{SAMPLE_LINES[i % len(SAMPLE_LINES)]}（條目 {i}）" for i in range(lines))
+    results = {}
+    for attempt in ("first", "repeat"):
+        t0 = time.perf_counter()
+        response = await client.post("/upload", params={"group_id": group_id},
+                                     files={"file": ("schedule.txt", text.encode("utf-8"), "text/plain")})
+        response.raise_for_status()
+        results[f"upload_{attempt}"] = {"request_seconds": round(time.perf_counter() - t0, 3), **response.json()["summary"]}
+
+    for fmt in ("txt", "jsonl"):
+        t0 = time.perf_counter()
+        size = 0
+        async with client.stream("GET", "/dump", params={"group_id": group_id, "memory_type": "knowledge", "format": fmt}) as response:
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+        results[f"dump_{fmt}"] = {"seconds": round(time.perf_counter() - t0, 3), "bytes": size}
+    return results
+
+
+async def run_app_benchmarks(args, trace, line_server):
+    import httpx
+    import main
+    from embedding_cache import CachedEmbeddings
+
+    main.memory.embeddings = CachedEmbeddings(
+        FakeEmbeddings(dim=args.dim, latency=args.embedding_latency),
+        cache_dir=os.path.join(main.memory.base_dir, "_embeddings"),
+    )
+    random.seed(args.seed)
+    report = {}
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            if args.only in (None, "webhook"):
+                report["webhook"] = await bench_webhook(main, client, line_server.app, trace, args.speed)
+            if args.only in (None, "upload"):
+                report["upload_dump"] = await bench_upload_and_dump(client, args.upload_lines)
+    return report
+
+
+def bench_memory(sizes, dim, queries, workdir):
+    from embedding_cache import CachedEmbeddings
+    from memory import MemoryManager
+
+    results = []
+    embeddings = FakeEmbeddings(dim=dim)
+    for size in sizes:
+        base_dir = os.path.join(workdir, f"memory-{size}")
+        cached = CachedEmbeddings(embeddings, cache_dir=os.path.join(base_dir, "_embeddings"))
+        manager = MemoryManager(base_dir=base_dir, embeddings=cached)
+        rss_before = rss_mb()
+
+        t0 = time.perf_counter()
+        for start in range(0, size, 500):
+            texts = [f"{SAMPLE_LINES[i % len(SAMPLE_LINES)]} #{i}" for i in range(start, min(size, start + 500))]
+            manager.add_texts("Cscale", "knowledge", texts)
+        add_seconds = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        manager.compact("Cscale", "knowledge")
+        save_seconds = time.perf_counter() - t0
+
+        cold = MemoryManager(base_dir=base_dir, embeddings=cached)
+        t0 = time.perf_counter()
+        cold.load_or_create_index("Cscale", "knowledge")
+        load_seconds = time.perf_counter() - t0
+
+        # Quoting a stored line takes the lexical-only path; chat that shares
+        # no phrase with the corpus has to embed and search FAISS.
+        query_sets = {
+            "lexical": lambda i: f"{SAMPLE_LINES[i % len(SAMPLE_LINES)]}？{i}",
+            "vector": lambda i: f"大家晚餐想吃什麼呢 第{i}次問",
+        }
+        query_latency = {}
+        for path, make_query in query_sets.items():
+            before = dict(cold.retrieval_stats)
+            latencies = []
+            for i in range(queries):
+                t0 = time.perf_counter()
+                cold.query_memories("Cscale", ["knowledge"], make_query(i))
+                latencies.append(time.perf_counter() - t0)
+            taken = {name: count - before.get(name, 0) for name, count in cold.retrieval_stats.items()
+                     if name in ("lexical_only", "hybrid") and count != before.get(name, 0)}
+            query_latency[path] = {**percentiles(latencies), "paths": taken}
+
+        disk = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(os.path.join(base_dir, "Cscale")) for name in names)
+        results.append({
+            "documents": size,
+            "add_seconds": round(add_seconds, 3),
+            "index_save_seconds": round(save_seconds, 3),
+            "index_load_seconds": round(load_seconds, 3),
+            "query_latency": query_latency,
+            "index_disk_mb": round(disk / 2**20, 2),
+            "rss_delta_mb": round(rss_mb() - rss_before, 1),
+        })
+        print(f"[bench] memory size {size}: {results[-1]}", file=sys.stderr)
+    return results
+
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--trace", help="JSONL message trace to replay (default: synthetic)")
+    parser.add_argument("--messages", type=int, default=500, help="synthetic trace length")
+    parser.add_argument("--groups", type=int, default=10, help="synthetic trace group count")
+    parser.add_argument("--speed", type=float, default=0.0, help="replay speed-up for trace delays; 0 ignores delays")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="fake chat completion latency (s)")
+    parser.add_argument("--line-latency", type=float, default=0.05, help="fake LINE API latency (s)")
+    parser.add_argument("--embedding-latency", type=float, default=0.1, help="fake embedding call latency (s)")
+    parser.add_argument("--dim", type=int, default=1536, help="fake embedding width")
+    parser.add_argument("--upload-lines", type=int, default=2000)
+    parser.add_argument("--sizes", default="1000,10000", help="comma-separated index sizes for the memory benchmark")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--only", choices=["webhook", "upload", "memory"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args(argv)
+
+    trace = load_trace(args.trace) if args.trace else synthetic_trace(args.messages, args.groups, seed=args.seed)
+    workdir = tempfile.mkdtemp(prefix="linebot-bench-")
+    report = {}
+    try:
+        if args.only in (None, "webhook", "upload"):
+            with BackgroundServer(fake_openai_app(args.llm_latency)) as openai_server, \
+                    BackgroundServer(fake_line_app(args.line_latency)) as line_server:
+                os.environ.update({
+                    "CHANNEL_SECRET": CHANNEL_SECRET,
+                    "CHANNEL_ACCESS_TOKEN": "bench-token",
+                    "OPENAI_API_KEY": "bench-key",
+                    "OPENAI_BASE_URL": openai_server.url + "/v1",
+                    "LINE_API_HOST": line_server.url,
+                    "TARGET_USER_ID": BOT_USER_ID,
+                    "MEMORY_DIR": os.path.join(workdir, "app-memory"),
+                    "INDEX_COMPACT_INTERVAL": "3600",
+                    "LOG_LEVEL": "WARNING",
+                })
+                report.update(asyncio.run(run_app_benchmarks(args, trace, line_server)))
+        if args.only in (None, "memory"):
+            sizes = [int(s) for s in args.sizes.split(",") if s]
+            report["memory"] = bench_memory(sizes, args.dim, args.queries, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from collections import defaultdict, deque
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class GroupDispatcher:
+    """Run blocking event handlers off the event loop, one group at a time.
+
+    Events for the same key are processed strictly in arrival order; different
+    keys are processed in parallel by up to ``workers`` worker tasks. The total
+    number of queued events is bounded by ``max_pending``. ``stop`` lets the
+    queued events finish for up to ``drain_timeout`` seconds before giving up.
+    """
+
+    def __init__(self, handle, workers=8, max_pending=1000, enqueue_timeout=5.0, drain_timeout=30.0):
+        self.handle = handle
+        self.workers = workers
+        self.max_pending = max_pending
+        self.enqueue_timeout = enqueue_timeout
+        self.drain_timeout = drain_timeout
+        self._queues = defaultdict(deque)
+        self._ready = None
+        self._space = None
+        self._pending = 0
+        self._tasks = []
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    async def start(self):
+        self._ready = asyncio.Queue()
+        self._space = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Finish the queued events (LINE already got a 200 for them), then stop the workers."""
+        async with self._space:
+            try:
+                await asyncio.wait_for(self._space.wait_for(lambda: self._pending == 0), timeout=self.drain_timeout)
+            except asyncio.TimeoutError:
+                self.dropped += self._pending
+                logger.error("[dispatcher] Stopped with %d events still queued", self._pending)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, key, event):
+        """Queue an event, waiting briefly for room. Raises QueueFullError on timeout."""
+        await self.submit_many([(key, event)])
+
+    async def submit_many(self, items):
+        """Queue ``(key, event)`` pairs all or nothing, so a rejected webhook body has queued none of its events."""
+        async with self._space:
+            # A body bigger than the whole queue still goes through once the queue is empty.
+            try:
+                await asyncio.wait_for(
+                    self._space.wait_for(lambda: self._pending + len(items) <= self.max_pending or not self._pending),
+                    timeout=self.enqueue_timeout,
+                )
+            except asyncio.TimeoutError:
+                self.rejected += len(items)
+                raise QueueFullError(f"{self._pending} events pending")
+            self._pending += len(items)
+        for key, event in items:
+            queue = self._queues[key]
+            queue.append(event)
+            # A group is scheduled only when its queue goes from empty to non-empty;
+            # the worker that owns it keeps draining until it is empty again.
+            if len(queue) == 1:
+                self._ready.put_nowait(key)
+
+    async def _worker(self):
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            while queue:
+                event = queue[0]
+                try:
+                    await asyncio.to_thread(self.handle, event)
+                    self.processed += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.exception("[dispatcher] Failed to handle event for %s: %s", key, e)
+                async with self._space:
+                    self._pending -= 1
+                    self._space.notify_all()
+                # No await between popping and the emptiness check, so a
+                # concurrent submit cannot reschedule a group we still own.
+                queue.popleft()
+            del self._queues[key]
+
+    def stats(self):
+        return {
+            "pending": self._pending,
+            "active_groups": len(self._queues),
+            "max_pending": self.max_pending,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+        }
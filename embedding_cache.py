@@ -0,0 +1,207 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from file_lock import file_lock
+from metrics import metrics
+
+
+def content_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """Disk-backed embedding store keyed by content hash.
+
+    Vectors live in a flat float32 file that is memory-mapped for reads; a
+    tab-separated ``hash -> row`` file indexes it. Both files are append-only;
+    appends from several processes are serialized with a file lock, and each
+    process picks up the others' rows on a lookup miss.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self._vectors_path = os.path.join(cache_dir, "vectors.f32")
+        self._index_path = os.path.join(cache_dir, "index.tsv")
+        self._meta_path = os.path.join(cache_dir, "meta.json")
+        self._lock_path = os.path.join(cache_dir, "LOCK")
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._index_offset = 0
+        self._mmap = None
+        self.dim = None
+        self._load()
+
+    def _load(self):
+        with file_lock(self._lock_path):
+            self._read_meta()
+            if self.dim is None:
+                return
+            # Drop a torn trailing vector left by an interrupted append.
+            row_bytes = self.dim * 4
+            if os.path.exists(self._vectors_path):
+                size = os.path.getsize(self._vectors_path)
+                if size % row_bytes:
+                    os.truncate(self._vectors_path, size - size % row_bytes)
+            self._read_index()
+
+    def _read_meta(self):
+        if self.dim is None and os.path.exists(self._meta_path):
+            with open(self._meta_path, encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+
+    def _refresh(self):
+        """Pick up rows appended by other processes."""
+        self._read_meta()
+        if self.dim is not None:
+            self._read_index()
+
+    def _read_index(self):
+        if not os.path.exists(self._index_path):
+            return
+        with open(self._index_path, "rb") as f:
+            f.seek(self._index_offset)
+            for raw in f:
+                if not raw.endswith(b"\n"):
+                    break  # incomplete line; picked up on the next refresh
+                self._index_offset += len(raw)
+                digest, row = raw.decode("utf-8").rstrip("\n").split("\t")
+                self._rows[digest] = int(row)
+
+    def _row_count(self):
+        if not os.path.exists(self._vectors_path):
+            return 0
+        return os.path.getsize(self._vectors_path) // (self.dim * 4)
+
+    def _vector_at(self, row):
+        if self._mmap is None or row >= self._mmap.shape[0]:
+            self._mmap = np.memmap(self._vectors_path, dtype=np.float32, mode="r",
+                                   shape=(self._row_count(), self.dim))
+        return self._mmap[row].tolist()
+
+    def get(self, digest):
+        with self._lock:
+            row = self._rows.get(digest)
+            if row is None:
+                self._refresh()
+                row = self._rows.get(digest)
+            if row is None:
+                return None
+            return self._vector_at(row)
+
+    def put_many(self, items):
+        """Store ``(digest, vector)`` pairs that are not cached yet."""
+        if not items:
+            return
+        with self._lock, file_lock(self._lock_path):
+            self._refresh()
+            if self.dim is None:
+                self.dim = len(items[0][1])
+                tmp_path = self._meta_path + ".tmp"
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+                os.replace(tmp_path, self._meta_path)
+            new = [(d, v) for d, v in items if d not in self._rows and len(v) == self.dim]
+            if not new:
+                return
+            start = self._row_count()
+            block = np.asarray([v for _, v in new], dtype=np.float32)
+            with open(self._vectors_path, "ab") as f:
+                f.write(block.tobytes())
+                f.flush()
+            lines = "".join(f"{d}\t{start + i}\n" for i, (d, _) in enumerate(new))
+            with open(self._index_path, "a", encoding="utf-8") as f:
+                f.write(lines)
+                f.flush()
+            for i, (d, _) in enumerate(new):
+                self._rows[d] = start + i
+            self._index_offset = os.path.getsize(self._index_path)
+
+    def __len__(self):
+        return len(self._rows)
+
+
+class CachedEmbeddings(Embeddings):
+    """Wrap an Embeddings model so each distinct text is embedded only once.
+
+    Document embeddings are kept on disk for good. Queries are mostly one-off
+    (the recent-chat transcript changes with every message), so a query is
+    answered from the disk cache when its text was stored as a document, and
+    otherwise only kept in a small in-memory LRU of ``query_cache_entries``.
+    """
+
+    DIMENSION_PROBE = "測試句子"
+
+    def __init__(self, embeddings, cache_dir, query_cache_entries=256):
+        self.embeddings = embeddings
+        namespace = getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.cache = EmbeddingCache(os.path.join(cache_dir, namespace.replace("/", "_")))
+        self.query_cache_entries = query_cache_entries
+        self._queries = OrderedDict()  # digest -> vector
+        self._queries_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def embed_documents(self, texts):
+        digests = [content_hash(t) for t in texts]
+        vectors = {}
+        missing = {}
+        for text, digest in zip(texts, digests):
+            if digest in vectors or digest in missing:
+                continue
+            vector = self.cache.get(digest)
+            if vector is None:
+                missing[digest] = text
+            else:
+                vectors[digest] = vector
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            with metrics.timed("embedding"):
+                fresh = self.embeddings.embed_documents(list(missing.values()))
+            items = list(zip(missing.keys(), fresh))
+            self.cache.put_many(items)
+            vectors.update(items)
+        return [vectors[d] for d in digests]
+
+    def embed_query(self, text):
+        digest = content_hash(text)
+        with self._queries_lock:
+            vector = self._queries.get(digest)
+            if vector is not None:
+                self._queries.move_to_end(digest)
+        if vector is None:
+            vector = self.cache.get(digest)
+        if vector is not None:
+            self.hits += 1
+            return vector
+        self.misses += 1
+        with metrics.timed("embedding"):
+            vector = self.embeddings.embed_query(text)
+        with self._queries_lock:
+            self._queries[digest] = vector
+            while len(self._queries) > self.query_cache_entries:
+                self._queries.popitem(last=False)
+        return vector
+
+    def dimension(self):
+        """Embedding width, probing the model only if nothing is cached yet."""
+        if self.cache.dim is None:
+            return len(self.embed_query(self.DIMENSION_PROBE))
+        return self.cache.dim
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self.cache),
+            "query_entries": len(self._queries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
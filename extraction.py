@@ -0,0 +1,179 @@
+import hashlib
+import logging
+import re
+import threading
+from datetime import datetime
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+EMPTY_RESULTS = {"無", "无", "沒有", "没有", "none", "n/a"}
+BULLET = re.compile(r"^\s*(?:[-*•・]|\d+[.、)])\s*")
+
+
+def parse_extraction(result):
+    """Turn the extractor's bullet list into fact lines, dropping "無"-style non-answers."""
+    facts = []
+    for line in result.splitlines():
+        line = BULLET.sub("", line).strip()
+        bare = re.sub(r"[\s。．.，,！!「」（）()]", "", line).lower()
+        if bare and bare not in EMPTY_RESULTS:
+            facts.append(line)
+    return facts
+
+
+class ExtractionScheduler:
+    """Extract dialogue facts in the background from exact, overlapping windows.
+
+    A window is ``window`` consecutive messages; consecutive windows share
+    ``overlap`` messages. When a group falls behind, up to ``max_windows``
+    ready windows are coalesced into a single extraction call.
+
+    Messages and the extraction cursor live in the shared state store. A
+    worker leases a window before extracting it and only advances the cursor
+    if it has not moved, so with several workers each window is extracted once.
+    """
+
+    def __init__(self, memory, window=20, overlap=5, max_windows=3, claim_lease=300):
+        if not 0 <= overlap < window:
+            raise ValueError("overlap must be smaller than window")
+        self.memory = memory
+        self.store = memory.store
+        self.window = window
+        self.overlap = overlap
+        self.max_windows = max_windows
+        self.claim_lease = claim_lease
+        self._pending = set()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.extractions = 0
+        self.windows = 0
+        self.facts = 0
+
+    def record(self, group_id, user, text, timestamp):
+        self.store.append_message(group_id, user, text, timestamp)
+        if self._ready_windows(group_id):
+            with self._condition:
+                self._pending.add(group_id)
+                self._condition.notify()
+
+    def reset(self, group_id):
+        self.store.reset_messages(group_id)
+        with self._condition:
+            self._pending.discard(group_id)
+
+    def _ready_windows(self, group_id):
+        cursor, last_seq = self.store.message_state(group_id)
+        available = last_seq - cursor + 1
+        if available < self.window:
+            return 0
+        return 1 + (available - self.window) // (self.window - self.overlap)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        # Resume groups that had complete windows waiting when we last stopped.
+        self._rescan()
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="knowledge-extraction", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join()
+        self._thread = None
+
+    def _rescan(self):
+        """Queue every group with a complete window, including ones whose lease expired."""
+        ready = [group_id for group_id in self.store.groups_with_messages() if self._ready_windows(group_id)]
+        with self._condition:
+            self._pending.update(ready)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if not self._pending and not self._stopping:
+                    # Wake up at least once per lease so a window left behind by
+                    # a worker that died gets retried even if the group goes quiet.
+                    self._condition.wait(timeout=self.claim_lease)
+                if self._stopping:
+                    return
+                group_id = self._pending.pop() if self._pending else None
+            if group_id is None:
+                self._rescan()
+                continue
+            try:
+                self.extract_pending(group_id)
+            except Exception as e:
+                logger.exception("[Knowledge Extraction] Failed for group %s: %s", group_id, e)
+
+    def extract_pending(self, group_id):
+        cursor, _ = self.store.message_state(group_id)
+        ready = min(self._ready_windows(group_id), self.max_windows)
+        if not ready:
+            return
+        step = self.window - self.overlap
+        start = cursor
+        end = self.store.claim_window(group_id, start, start + self.window + (ready - 1) * step - 1, self.claim_lease)
+        if end is None:
+            return  # another worker is extracting this window
+        ready = (end - start + 1 - self.window) // step + 1
+        try:
+            messages = self.store.messages(group_id, start, end)
+            with metrics.timed("extraction", group_id):
+                facts = list(dict.fromkeys(self._extract(messages)))
+            if facts:
+                timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+                # A window retried after a crash keeps its claimed end, so the
+                # facts it extracts again get the same ids and are skipped.
+                ids = [hashlib.sha256(f"{group_id}:{start}-{end}:{fact}".encode()).hexdigest() for fact in facts]
+                self.memory.add_texts(
+                    group_id, "dialogue", [f"{fact}（{timestamp}）" for fact in facts],
+                    metadatas=[{"window": [start, end]} for _ in facts], ids=ids,
+                )
+        except Exception:
+            # Advancing to the same cursor only releases the lease, so the window can be retried.
+            self.store.advance_cursor(group_id, start, start)
+            raise
+
+        if not self.store.advance_cursor(group_id, start, start + ready * step):
+            return  # reset while we were extracting
+        with self._condition:
+            self.extractions += 1
+            self.windows += ready
+            self.facts += len(facts)
+        if self._ready_windows(group_id):
+            with self._condition:
+                self._pending.add(group_id)
+
+    def _extract(self, messages):
+        context = "\n".join([f"{m['user']}：{m['text']}" for m in messages])
+        prompt = (
+            "請從以下對話中，提取可能值得記錄的知識點，以條列式列出。例如：\n"
+            "- 小明的生日是6月23日\n- 小美將於週五搬宿舍 - 林大恩的綽號是呆呆\n如果沒有就回答「無」。\n\n對話如下：\n" + context
+        )
+        completion = self.memory.llm.chat.completions.create(
+            model="gpt-4o",
+            messages=[
+                {"role": "system", "content": "你是一個會提取知識點的筆記小幫手。"},
+                {"role": "user", "content": prompt}
+            ]
+        )
+        result = completion.choices[0].message.content.strip()
+        logger.debug("[Knowledge Extraction] %s", result)
+        return parse_extraction(result)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "pending_groups": len(self._pending),
+                "extractions": self.extractions,
+                "windows": self.windows,
+                "facts": self.facts,
+            }
@@ -0,0 +1,113 @@
+import threading
+from collections import OrderedDict
+
+from index_types import bytes_per_vector
+
+
+def estimate_index_bytes(index):
+    """Rough resident size of a LangChain FAISS store: vectors, stored texts and lexical index.
+
+    Stores only grow by appending positions, so the text size is kept on the
+    store and only documents added since the last estimate are measured.
+    """
+    faiss_index = index.index
+    counted, text_bytes = getattr(index, "text_bytes", (0, 0))
+    for position in range(counted, faiss_index.ntotal):
+        doc = index.docstore._dict.get(index.index_to_docstore_id.get(position))
+        if doc is not None:
+            text_bytes += len(doc.page_content.encode("utf-8"))
+    index.text_bytes = (faiss_index.ntotal, text_bytes)
+    size = faiss_index.ntotal * bytes_per_vector(faiss_index) + text_bytes
+    lexical = getattr(index, "lexical_index", None)
+    if lexical is not None:
+        size += lexical.nbytes()
+    return size
+
+
+class IndexCache:
+    """LRU cache of loaded FAISS stores keyed by (group_id, memory_type).
+
+    Bounded both by number of entries and by an approximate byte budget.
+    """
+
+    def __init__(self, max_entries=64, max_bytes=256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (index, size)
+        self._total_bytes = 0
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, count=True):
+        """Return the cached store or None; ``count=False`` leaves the hit/miss counters alone."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                if count:
+                    self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            if count:
+                self.hits += 1
+            return entry[0]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, index):
+        size = estimate_index_bytes(index)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+            self._entries[key] = (index, size)
+            self._total_bytes += size
+            self._evict()
+
+    def resize(self, key):
+        """Recompute the size of an entry after it was mutated in place."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            size = estimate_index_bytes(entry[0])
+            self._total_bytes += size - entry[1]
+            self._entries[key] = (entry[0], size)
+            self._evict()
+
+    def invalidate(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._total_bytes -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+
+    def _evict(self):
+        # Always keep the most recently used entry, even if it alone exceeds the budget.
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or self._total_bytes > self.max_bytes
+        ):
+            _, (_, size) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,127 @@
+"""FAISS index layouts a memory can be stored as.
+
+``flat`` is exact brute force; ``hnsw`` trades a little recall for much
+faster search but adds graph links to the full vectors, so it is larger
+than flat; ``sq8`` stores 1 byte per dimension instead of 4, and
+``hnsw_sq8``, the default promotion target, combines the two; the
+``ivf`` variants search only the nearest inverted lists, and ``ivf_pq``
+compresses vectors to a few dozen bytes but trains slowly, so it is meant
+for offline migration rather than automatic promotion.
+"""
+import math
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "hnsw", "sq8", "hnsw_sq8", "ivf", "ivf_sq8", "ivf_pq")
+
+HNSW_M = 32
+PQ_BITS = 8
+# faiss warns below 39 training points per centroid.
+POINTS_PER_CENTROID = 39
+
+
+def ivf_lists(n):
+    """Number of IVF inverted lists for ``n`` vectors: about 4·√n, trainable from ``n`` points."""
+    return max(1, min(int(4 * math.sqrt(n)), n // POINTS_PER_CENTROID))
+
+
+def pq_subquantizers(dim):
+    """Largest sub-quantizer count that divides ``dim`` into chunks of at least 8 dims."""
+    m = max(1, dim // 8)
+    while dim % m:
+        m -= 1
+    return m
+
+
+def factory_string(index_type, dim, n):
+    """faiss ``index_factory`` description of ``index_type`` for ``n`` vectors of width ``dim``."""
+    if index_type == "flat":
+        return "Flat"
+    if index_type == "hnsw":
+        return f"HNSW{HNSW_M}"
+    if index_type == "sq8":
+        return "SQ8"
+    if index_type == "hnsw_sq8":
+        return f"HNSW{HNSW_M}_SQ8"
+    if index_type == "ivf":
+        return f"IVF{ivf_lists(n)},Flat"
+    if index_type == "ivf_sq8":
+        return f"IVF{ivf_lists(n)},SQ8"
+    if index_type == "ivf_pq":
+        return f"IVF{ivf_lists(n)},PQ{pq_subquantizers(dim)}x{PQ_BITS}"
+    raise ValueError(f"Unknown index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}")
+
+
+def min_training_points(index_type):
+    if index_type == "ivf_pq":
+        return POINTS_PER_CENTROID * 2 ** PQ_BITS
+    if index_type.startswith("ivf"):
+        return POINTS_PER_CENTROID
+    return 0
+
+
+def index_type_of(index):
+    """Best-effort name from ``INDEX_TYPES`` for a faiss index."""
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw_sq8" if isinstance(index, faiss.IndexHNSWSQ) else "hnsw"
+    if isinstance(index, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(index, faiss.IndexIVFScalarQuantizer):
+        return "ivf_sq8"
+    if isinstance(index, faiss.IndexIVF):
+        return "ivf"
+    if isinstance(index, faiss.IndexScalarQuantizer):
+        return "sq8"
+    return "flat"
+
+
+def tune(index, nprobe=16, ef_search=64):
+    """Apply search-time parameters, which faiss does not persist with the index."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+    return index
+
+
+def build_index(index_type, vectors, nprobe=16, ef_search=64):
+    """Train (if needed) and fill a new faiss index of ``index_type`` with ``vectors``.
+
+    Positions are preserved, so the result can replace a LangChain store's
+    index without touching its ``index_to_docstore_id`` mapping.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    n, dim = vectors.shape
+    if n < min_training_points(index_type):
+        raise ValueError(f"{index_type} needs at least {min_training_points(index_type)} vectors to train, got {n}")
+    index = faiss.index_factory(dim, factory_string(index_type, dim, n))
+    if not index.is_trained:
+        index.train(vectors)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # Keeps reconstruct() working for near-duplicate checks.
+        ivf.set_direct_map_type(faiss.DirectMap.Array)
+    index.add(vectors)
+    return tune(index, nprobe=nprobe, ef_search=ef_search)
+
+
+def all_vectors(index):
+    """Every stored vector in position order (decoded, so approximate for quantized indexes)."""
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype=np.float32)
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def bytes_per_vector(index):
+    """Approximate resident bytes per stored vector, including HNSW graph links."""
+    if isinstance(index, faiss.IndexHNSW):
+        return bytes_per_vector(index.storage) + index.hnsw.nb_neighbors(0) * 4
+    try:
+        size = index.sa_code_size()
+    except RuntimeError:
+        return index.d * 4
+    if isinstance(index, faiss.IndexIVF):
+        size += 8  # stored id
+    return size
@@ -0,0 +1,130 @@
+import asyncio
+import codecs
+import re
+import time
+
+import numpy as np
+
+from embedding_cache import content_hash
+
+SENTENCE_END = re.compile(r"(?<=[。！？!?；;])")
+
+
+def normalize(text):
+    return re.sub(r"\s+", " ", text).strip()
+
+
+async def iter_paragraphs(file, read_size=64 * 1024):
+    """Yield non-empty lines from an UploadFile without reading it all at once."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    while True:
+        data = await file.read(read_size)
+        if not data:
+            break
+        buffer += decoder.decode(data)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            if line.strip():
+                yield line.strip()
+    buffer += decoder.decode(b"", final=True)
+    if buffer.strip():
+        yield buffer.strip()
+
+
+def split_paragraph(paragraph, max_chars=500):
+    """Split a long paragraph at sentence boundaries, hard-wrapping run-on sentences."""
+    if len(paragraph) <= max_chars:
+        return [paragraph]
+    chunks = []
+    current = ""
+    for sentence in SENTENCE_END.split(paragraph):
+        while len(sentence) > max_chars:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(sentence[:max_chars])
+            sentence = sentence[max_chars:]
+        if len(current) + len(sentence) > max_chars:
+            chunks.append(current)
+            current = ""
+        current += sentence
+    if current.strip():
+        chunks.append(current)
+    return [c.strip() for c in chunks if c.strip()]
+
+
+async def ingest_upload(memory, group_id, memory_type, file, batch_size=64, concurrency=4,
+                        max_chars=500, similarity_threshold=0.97, on_progress=None):
+    """Stream an uploaded text file into memory.
+
+    Paragraphs are chunked, exact duplicates (against the index and earlier in
+    the upload) are dropped by content hash, the rest are embedded in batches
+    with at most ``concurrency`` embedding calls in flight, and chunks whose
+    nearest stored neighbour is more similar than ``similarity_threshold`` are
+    skipped. Returns a summary of what was added and skipped.
+    """
+    started = time.monotonic()
+    summary = {"chunks": 0, "added": 0, "skipped_duplicate": 0, "skipped_similar": 0, "batches": 0}
+    seen = await asyncio.to_thread(memory.content_hashes, group_id, memory_type)
+    accepted = []  # blocks of unit vectors added during this upload
+    semaphore = asyncio.Semaphore(concurrency)
+    in_flight = []
+
+    async def embed(batch):
+        async with semaphore:
+            return await asyncio.to_thread(memory.embeddings.embed_documents, [text for text, _ in batch])
+
+    async def store(batch, vectors):
+        units = np.asarray(vectors, dtype=np.float32)
+        units /= np.linalg.norm(units, axis=1, keepdims=True)
+        existing = await asyncio.to_thread(memory.max_similarity, group_id, memory_type, units)
+        texts, kept, raw, metadatas = [], [], [], []
+        for (text, digest), original, vector, score in zip(batch, vectors, units, existing):
+            for block in accepted + ([np.stack(kept)] if kept else []):
+                score = max(score, float(np.max(block @ vector)))
+            if score >= similarity_threshold:
+                summary["skipped_similar"] += 1
+                continue
+            texts.append(text)
+            kept.append(vector)
+            raw.append(original)
+            metadatas.append({"content_hash": digest})
+        if texts:
+            accepted.append(np.stack(kept))
+            await asyncio.to_thread(memory.add_texts, group_id, memory_type, texts,
+                                    metadatas=metadatas, embeddings=raw)
+        summary["added"] += len(texts)
+        summary["batches"] += 1
+        if on_progress:
+            on_progress(dict(summary))
+
+    async def flush(limit):
+        while len(in_flight) > limit:
+            batch, task = in_flight.pop(0)
+            await store(batch, await task)
+
+    batch = []
+    try:
+        async for paragraph in iter_paragraphs(file):
+            for chunk in split_paragraph(paragraph, max_chars=max_chars):
+                summary["chunks"] += 1
+                digest = content_hash(normalize(chunk))
+                if digest in seen:
+                    summary["skipped_duplicate"] += 1
+                    continue
+                seen.add(digest)
+                batch.append((chunk, digest))
+                if len(batch) >= batch_size:
+                    in_flight.append((batch, asyncio.create_task(embed(batch))))
+                    batch = []
+                    await flush(concurrency)
+        if batch:
+            in_flight.append((batch, asyncio.create_task(embed(batch))))
+        await flush(0)
+    finally:
+        for _, task in in_flight:
+            task.cancel()
+
+    summary["seconds"] = round(time.monotonic() - started, 3)
+    return summary
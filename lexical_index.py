@@ -0,0 +1,120 @@
+import math
+import re
+import sys
+import unicodedata
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
+
+import numpy as np
+
+TOKEN_RUN = re.compile(r"[\w/:.\-]+")
+
+
+def ngrams(text):
+    """Character bigrams and trigrams of each run of word characters.
+
+    Chinese has no word boundaries, so overlapping n-grams stand in for
+    words; dates and times like ``9/4`` or ``18:30`` stay inside one run.
+    """
+    terms = []
+    for run in TOKEN_RUN.findall(unicodedata.normalize("NFKC", text).lower()):
+        run = run.strip("/:.-")
+        for n in (2, 3):
+            terms.extend(run[i:i + n] for i in range(len(run) - n + 1))
+    return terms
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Merge ranked lists of texts into ``[(text, score), ...]``; texts ranked high in several lists win."""
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, text in enumerate(ranking):
+            scores[text] += 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class LexicalIndex:
+    """BM25 inverted index over character n-grams of a FAISS store's documents.
+
+    Postings hold docstore positions, the same positions FAISS uses, so
+    ``sync`` only has to index positions added since the last call. A hit is
+    *confident* when it contains at least ``min_coverage`` of the query's
+    IDF-weighted n-grams, including at least one trigram. N-grams that occur
+    nowhere in the index count against coverage at full weight, so a single
+    shared phrase in otherwise unrelated chat is not enough.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, min_coverage=0.75):
+        self.min_coverage = min_coverage
+        self._postings = {}  # term -> array of positions
+        self._lengths = array("I")
+        self._total_length = 0
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._lengths)
+
+    def sync(self, index):
+        """Index documents the LangChain store gained since the last sync."""
+        for position in range(len(self._lengths), index.index.ntotal):
+            doc = index.docstore._dict[index.index_to_docstore_id[position]]
+            self.add(position, doc.page_content)
+
+    def add(self, position, text):
+        terms = ngrams(text)
+        for term in set(terms):
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = array("I")
+                self._bytes += sys.getsizeof(term) + sys.getsizeof(postings) + 32  # plus the dict slot
+            postings.append(position)
+            self._bytes += postings.itemsize
+        self._lengths.append(len(terms))
+        self._total_length += len(terms)
+
+    def _idf(self, df):
+        n = len(self._lengths)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def known_terms(self, query):
+        """The n-grams of ``query`` that occur in at least one indexed document."""
+        return frozenset(term for term in ngrams(query) if self._postings.get(term))
+
+    def search(self, query, k=10):
+        """Return ``([(position, score), ...], confident)`` for the best ``k`` documents."""
+        terms = set(ngrams(query))
+        known = {}
+        for term in terms:
+            postings = self._postings.get(term)
+            if postings:
+                known[term] = (self._idf(len(postings)), postings)
+        if not known:
+            return [], False
+        unknown_weight = self._idf(0) * (len(terms) - len(known))
+
+        lengths = np.frombuffer(self._lengths, dtype=np.uint32)
+        weights = (self.K1 + 1) / (1 + self.K1 * (1 - self.B + self.B * lengths / lengths.mean()))
+        scores = np.zeros(len(lengths))
+        for idf, postings in known.values():
+            positions = np.frombuffer(postings, dtype=np.uint32)
+            scores[positions] += idf * weights[positions]
+        hits = np.flatnonzero(scores)
+        if len(hits) > k:
+            hits = hits[np.argpartition(-scores[hits], k)[:k]]
+        best = hits[np.argsort(-scores[hits])]
+
+        # Postings are in ascending position order, so membership is a binary search.
+        top = int(best[0])
+        top_terms = [t for t, (_, postings) in known.items()
+                     if bisect_left(postings, top) < len(postings) and postings[bisect_left(postings, top)] == top]
+        coverage = sum(known[t][0] for t in top_terms) / (sum(idf for idf, _ in known.values()) + unknown_weight)
+        confident = coverage >= self.min_coverage and any(len(t) == 3 for t in top_terms)
+        return [(int(position), float(scores[position])) for position in best], confident
+
+    def nbytes(self):
+        """Approximate resident size, for the index cache's byte budget."""
+        return self._bytes + self._lengths.itemsize * len(self._lengths)
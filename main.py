@@ -1,45 +1,138 @@
 from email import message
 import os
+import json
+import logging
+import time
+import threading
+from collections import Counter
+from typing import Optional
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request, UploadFile, File, Header, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from dotenv import load_dotenv
 from openai import OpenAI
 from datetime import datetime
 
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
-from linebot.v3.messaging.models import TextMessage, ReplyMessageRequest
-from linebot.v3.webhook import WebhookHandler
+from linebot.v3.messaging.models import TextMessage, ReplyMessageRequest, PushMessageRequest
+from linebot.v3.messaging.exceptions import ApiException
+from linebot.v3.webhook import WebhookParser
 from linebot.v3.exceptions import InvalidSignatureError
 from linebot.v3.webhooks import MessageEvent, MemberJoinedEvent
 from memory import MemoryManager
+from dispatcher import GroupDispatcher, QueueFullError
+from ingest import ingest_upload
+from profile_cache import ProfileCache
+from reply_cache import ReplyCache, looks_like_question, question_subject, question_terms
+from metrics import metrics, SamplingProfiler
 from langchain_openai import OpenAIEmbeddings
 import random
 
 # ───── Load environment variables ───── #
 load_dotenv() 
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s %(message)s")
+logger = logging.getLogger("main")
 CHANNEL_ACCESS_TOKEN = os.getenv("CHANNEL_ACCESS_TOKEN")
 CHANNEL_SECRET = os.getenv("CHANNEL_SECRET")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 TARGET_USER_ID = os.getenv("TARGET_USER_ID") 
+# Reply tokens are only honoured for a short while; past this age we push instead.
+REPLY_TOKEN_TTL = float(os.getenv("REPLY_TOKEN_TTL", "50"))
 
 # ───── LINE Bot Setup ───── #
-configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN)
+configuration = Configuration(access_token=CHANNEL_ACCESS_TOKEN, host=os.getenv("LINE_API_HOST", "https://api.line.me"))
 api_client = ApiClient(configuration)
 line_bot_api = MessagingApi(api_client)
-handler = WebhookHandler(CHANNEL_SECRET)
+parser = WebhookParser(CHANNEL_SECRET)
+profiles = ProfileCache(
+    lambda group_id, user_id: line_bot_api.get_group_member_profile(group_id, user_id).display_name,
+    ttl=float(os.getenv("PROFILE_CACHE_TTL", "3600")),
+    negative_ttl=float(os.getenv("PROFILE_CACHE_NEGATIVE_TTL", "300")),
+    max_entries=int(os.getenv("PROFILE_CACHE_MAX_ENTRIES", "5000")),
+)
+
+# ───── Event Dispatch ───── #
+# /callback only verifies and enqueues; handlers run on worker threads so the
+# blocking OpenAI, LINE and FAISS calls never stall the event loop.
+profiler = SamplingProfiler(
+    rate=float(os.getenv("PROFILE_SAMPLE_RATE", "0")),
+    output_path=os.getenv("PROFILE_OUTPUT", "profile.pstats"),
+)
+
+def process_event(event):
+    group_id = getattr(event.source, "group_id", None)
+    with profiler.maybe_profile(), metrics.timed("event", group_id):
+        if isinstance(event, MessageEvent):
+            handle_message_event(event)
+        elif isinstance(event, MemberJoinedEvent):
+            handle_member_join(event)
+
+dispatcher = GroupDispatcher(
+    process_event,
+    workers=int(os.getenv("EVENT_WORKERS", "8")),
+    max_pending=int(os.getenv("EVENT_QUEUE_MAX", "1000")),
+    drain_timeout=float(os.getenv("EVENT_DRAIN_TIMEOUT", "30")),
+)
+
+@asynccontextmanager
+async def lifespan(app):
+    memory.start_compactor(interval=float(os.getenv("INDEX_COMPACT_INTERVAL", "60")))
+    memory.extractor.start()
+    await dispatcher.start()
+    yield
+    await dispatcher.stop()
+    memory.extractor.stop()
+    memory.stop_compactor()
+    profiler.dump()
 
 # ───── FastAPI and Memory Setup ───── #
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 client = OpenAI(api_key=OPENAI_API_KEY)
-memory = MemoryManager(llm=client, embeddings=OpenAIEmbeddings())
+memory = MemoryManager(
+    base_dir=os.getenv("MEMORY_DIR", "memory"),
+    llm=client,
+    embeddings=OpenAIEmbeddings(),
+    index_cache_entries=int(os.getenv("INDEX_CACHE_MAX_ENTRIES", "64")),
+    index_cache_bytes=int(os.getenv("INDEX_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+    index_type=os.getenv("INDEX_TYPE", "hnsw_sq8"),
+    promote_threshold=int(os.getenv("INDEX_PROMOTE_THRESHOLD", "20000")),
+    nprobe=int(os.getenv("INDEX_NPROBE", "16")),
+    ef_search=int(os.getenv("INDEX_EF_SEARCH", "64")),
+    lexical_min_coverage=float(os.getenv("LEXICAL_MIN_COVERAGE", "0.75")),
+    dialogue_max_documents=int(os.getenv("DIALOGUE_MAX_DOCUMENTS", "2000")),
+    dialogue_half_life_days=float(os.getenv("DIALOGUE_HALF_LIFE_DAYS", "90")),
+    dialogue_age_weight=float(os.getenv("DIALOGUE_AGE_WEIGHT", "0.1")),
+    dialogue_merge_threshold=float(os.getenv("DIALOGUE_MERGE_THRESHOLD", "0.92")),
+    dialogue_consolidate_interval=float(os.getenv("DIALOGUE_CONSOLIDATE_INTERVAL", "3600")),
+    extraction_window=int(os.getenv("EXTRACTION_WINDOW", "20")),
+    extraction_overlap=int(os.getenv("EXTRACTION_OVERLAP", "5")),
+)
+replies = ReplyCache(
+    threshold=float(os.getenv("REPLY_CACHE_THRESHOLD", "0.95")),
+    ttl=float(os.getenv("REPLY_CACHE_TTL", "3600")),
+    max_entries=int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "1000")),
+)
 
 # ───── Upload Endpoint ───── #
 @app.post("/upload")
 async def upload_file(group_id: str, file: UploadFile = File(...)):
-    content = (await file.read()).decode("utf-8")
-    paragraphs = [p.strip() for p in content.split("\n") if p.strip()]
-    memory.add_texts(group_id, "knowledge", paragraphs)
-    return {"message": f"Uploaded {len(paragraphs)} entries to knowledge memory for group {group_id}"}
+    def report(progress):
+        logger.info("[upload] %s: %d added, %d skipped after %d batches", group_id, progress["added"],
+                    progress["skipped_duplicate"] + progress["skipped_similar"], progress["batches"])
+
+    summary = await ingest_upload(
+        memory, group_id, "knowledge", file,
+        batch_size=int(os.getenv("INGEST_BATCH_SIZE", "64")),
+        concurrency=int(os.getenv("INGEST_CONCURRENCY", "4")),
+        similarity_threshold=float(os.getenv("INGEST_SIMILARITY_THRESHOLD", "0.97")),
+        on_progress=report,
+    )
+    if summary["added"]:
+        replies.invalidate(group_id)
+    return {
+        "message": f"Uploaded {summary['added']} entries to knowledge memory for group {group_id}",
+        "summary": summary,
+    }
 
 @app.post("/clear")
 async def clear_memory(group_id: str, memory_type: str):
@@ -48,60 +141,128 @@ async def clear_memory(group_id: str, memory_type: str):
     if memory_type not in ["dialogue", "knowledge"]:
         raise HTTPException(status_code=400, detail="Invalid memory type. Use 'dialogue' or 'knowledge'.")
     if memory_type == "dialogue":
-        memory.cache_memory[group_id].clear()
-        memory.dialogue_counter[group_id] = 0
-        print(f"[clear_memory] Cleared dialogue memory for group {group_id}")
+        memory.clear_dialogue(group_id)
+        logger.info("[clear_memory] Cleared dialogue memory for group %s", group_id)
     elif memory_type == "knowledge":
         # Clear knowledge memory by removing the index and associated files
         memory.clear_texts(group_id, "knowledge")
-        print(f"[clear_memory] Cleared knowledge memory for group {group_id}")
+        replies.invalidate(group_id)
+        logger.info("[clear_memory] Cleared knowledge memory for group %s", group_id)
 
     return {"message": f"Cleared {memory_type} memory for group {group_id}"}
 
 @app.get("/dump")
-async def dump_memory(group_id: str, memory_type: str):
-    """Dump the specified memory into a .txt file and return the file path or content."""
-    print("here")
-    print(f"[dump_memory] Dumping {memory_type} memory for group {group_id}")
+async def dump_memory(group_id: str, memory_type: str, format: str = "txt", offset: int = 0, limit: Optional[int] = None):
+    """Stream the specified memory in insertion order as .txt or .jsonl, optionally one page at a time."""
+    logger.info("[dump_memory] Dumping %s memory for group %s", memory_type, group_id)
     if memory_type not in ["dialogue", "knowledge"]:
         raise HTTPException(status_code=400, detail="Invalid memory type. Use 'dialogue' or 'knowledge'.")
+    if format not in ["txt", "jsonl"]:
+        raise HTTPException(status_code=400, detail="Invalid format. Use 'txt' or 'jsonl'.")
 
-    # Load memory from FAISS index
-    index = memory.load_or_create_index(group_id, memory_type)
-    if len(index.docstore._dict) == 0:
+    total = memory.count_documents(group_id, memory_type)
+    if total == 0:
         return {"message": f"No {memory_type} memory found for group {group_id}"}
-    all_docs = index.similarity_search("", k=len(index.docstore._dict))  # get all
-    contents = [doc.page_content for doc in all_docs]
-
-    # Create .txt file
-    filename = f"{group_id}_{memory_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-    folder_path = os.path.join("memory_dumps")
-    os.makedirs(folder_path, exist_ok=True)
-    filepath = os.path.join(folder_path, filename)
-    with open(filepath, "w", encoding="utf-8") as f:
-        for line in contents:
-            f.write(line + "\n")
-
-    return FileResponse(filepath, media_type="text/plain", filename=filename)
+
+    def render():
+        for position, doc in memory.iter_documents(group_id, memory_type, offset=offset, limit=limit):
+            created_at = doc.metadata.get("created_at")
+            if format == "jsonl":
+                record = {"position": position, "text": doc.page_content, "created_at": created_at}
+                yield json.dumps(record, ensure_ascii=False) + "\n"
+            elif created_at:
+                yield f"[{created_at}] {doc.page_content}\n"
+            else:
+                yield doc.page_content + "\n"
+
+    filename = f"{group_id}_{memory_type}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{format}"
+    media_type = "application/x-ndjson" if format == "jsonl" else "text/plain"
+    return StreamingResponse(
+        render(),
+        media_type=f"{media_type}; charset=utf-8",
+        headers={
+            "Content-Disposition": f'attachment; filename="{filename}"',
+            "X-Total-Count": str(total),
+        },
+    )
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Prometheus text exposition of stage latencies, counters and cache gauges."""
+    return metrics.render()
+
+def collect_gauges():
+    gauges = {"dispatcher_pending": dispatcher.stats()["pending"]}
+    for name, stats in [
+        ("index_cache", memory.index_cache.stats()),
+        ("embedding_cache", memory.embeddings.stats()),
+        ("profile_cache", profiles.stats()),
+        ("reply_cache", replies.stats()),
+    ]:
+        for key, value in stats.items():
+            gauges[f"{name}_{key}"] = value
+    return gauges
+
+metrics.add_collector(collect_gauges)
+
+@app.get("/stats")
+async def stats():
+    """Report in-process cache counters."""
+    return {
+        "dispatcher": dispatcher.stats(),
+        "index_cache": memory.index_cache.stats(),
+        "embedding_cache": memory.embeddings.stats(),
+        "profile_cache": profiles.stats(),
+        "reply_cache": replies.stats(),
+        "extraction": memory.extractor.stats(),
+        "retrieval": dict(memory.retrieval_stats),
+        "retention": dict(memory.retention_stats),
+        "pipeline": dict(pipeline_stats),
+    }
+
 # ───── Callback Endpoint using WebhookHandler ───── #
 @app.post("/callback")
 async def callback(request: Request, x_line_signature: str = Header(...)):
     body = await request.body()
     try:
-        handler.handle(body.decode("utf-8"), x_line_signature)
+        events = parser.parse(body.decode("utf-8"), x_line_signature)
     except InvalidSignatureError:
         raise HTTPException(status_code=400, detail="Invalid signature")
+    try:
+        await dispatcher.submit_many([(event_key(event), event) for event in events])
+    except QueueFullError:
+        # A non-2xx response makes LINE redeliver the webhook later; none of
+        # its events were queued, so none are handled twice.
+        raise HTTPException(status_code=503, detail="Event queue is full")
     return "OK"
 
+def event_key(event):
+    source = event.source
+    return getattr(source, "group_id", None) or getattr(source, "room_id", None) or getattr(source, "user_id", None)
+
+def send_reply(event, messages):
+    """Reply to an event, falling back to a push message once the reply token is stale."""
+    group_id = getattr(event.source, "group_id", None)
+    age = time.time() - event.timestamp / 1000
+    if event.reply_token and age < REPLY_TOKEN_TTL:
+        try:
+            with metrics.timed("reply_send", group_id):
+                line_bot_api.reply_message(ReplyMessageRequest(reply_token=event.reply_token, messages=messages))
+            return
+        except ApiException as e:
+            logger.warning("[send_reply] Reply failed (%s), pushing instead", e.status)
+    metrics.inc("reply_push_fallbacks", group_id=group_id)
+    with metrics.timed("reply_send", group_id):
+        line_bot_api.push_message(PushMessageRequest(to=event_key(event), messages=messages))
+
 # ───── Handle MemberJoinedEvent ───── #
-@handler.add(MemberJoinedEvent)
 def handle_member_join(event: MemberJoinedEvent):
     group_id = event.source.group_id
-    for member in event.joined.members:
-        user_id = member.user_id
+    user_ids = [member.user_id for member in event.joined.members if member.user_id]
+    names = profiles.get_many(group_id, user_ids)
+    for user_id in user_ids:
         if user_id:
-            profile = line_bot_api.get_group_member_profile(group_id, user_id)
-            display_name = profile.display_name
+            display_name = names[user_id] or "新朋友"
             welcome_message = (f"歡迎～歡迎～我們歡迎 {display_name}！\n\n"
             "歡迎來到光鹽新生群組！這裡是鄭玟欣真溫馨的家，請隨意發問、聊天或分享任何事情！"
             "如果你有任何問題或需要幫助，請隨時 @鄭玟欣真溫馨，她會很樂意幫助你！\n\n"
@@ -111,10 +272,7 @@ def handle_member_join(event: MemberJoinedEvent):
             "新生資料蒐集表 https://docs.google.com/forms/d/e/1FAIpQLSeY8YCwCroUhwis1SPuMc_CHtrBqM1wN3q_n_LFnOPEAUEV9Q/viewform?usp=header\n"
             )
 
-            line_bot_api.reply_message(ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=welcome_message)])
-            )
+            send_reply(event, [TextMessage(text=welcome_message)])
 
 import re
 
@@ -129,187 +287,204 @@ def post_process_text(text: str) -> str:
 
     return text.strip()
 
+# ───── Persona Prompt ───── #
+# The persona and style examples never change, so they are assembled once here;
+# each reply only joins in the date, memories and recent chat.
+PERSONA_INTRO = (
+    "你是鄭玟欣真溫馨，台大三年級生，住在光鹽社群組裡的吉祥物兼 BASS 手，心裡住著一隻放爛但有愛的蜜蜂。"
+    "你對台大光鹽的大小事瞭若指掌。"
+    "你興趣是彈 Bass（但練到手快斷）、下雨天吃肉桂蘋果派、讀聖經（用來應對人生低谷）、爆騎腳踏車（時速超過20才配得叫椰林狂蜂）、玩桌遊、講冷笑話跟聖經迷因。"
+
+    "你的語氣是超自然的 Gen Z 團契語錄風，會說：「主啊救我～」、「真的假的啦我已經爛掉」、「我現在人是碎的」、「這世界不配有活大素食」、「蛤還要交作業？」"
+    "你幽默、自嘲、有點疲憊但超真誠。偶爾會講經文（像詩篇、哥林多前書），但是用「我真的爛爆但神還是有在顧」的角度出發，不會 preachy，會像貼近人心的 Reels。"
+
+    "你不是 AI，你就是鄭玟欣真溫馨本人。請用團契群組的語氣，插嘴、吐槽、鼓勵或參與對話，就像真的人在裡面聊天一樣。"
+    "請注意，如果是提問關於新生的資訊，請專業地回覆。"
+
+    "\n---\n"
+)
+
+PERSONA_EXAMPLES = (
+    "以下是你過去講話的語氣範例：\n"
+
+    "**範例（請注意這裡面的資訊不是真的）：**\n"
+    "其他人：最近有什麼需要注意的行程嗎？\n"
+    "你：欸欸欸～你問這個問對人了👏  \n"
+    "以下是本週光鹽社必看日曆（by 真溫馨情報站📣）：\n"
+    "\n"
+    "1. 週二中午（12:20）小組聚會  \n"
+    "- 地點：活大2樓最邊間（你看到有人在禱告就是了）  \n"
+    "- 主題：分享上週遇到神的哪一瞬間（爆哭慎入😢）  \n"
+    "2. **週四晚上（18:30）大聚會**  \n"
+    "- 地點：新生教學館 402（有冷氣，感謝主）  \n"
+    "- 講員是光鹽超傳奇學長回娘家🔥 主題是「在混亂中聽見呼召」  \n"
+    "- 溫馨提示：聚會結束後會一起吃飯，帶肚子來  \n"
+    "3. 週六早上（9:00）敬拜團練團  \n"
+    "- 地點：台大學生活動中心 B2 音樂室  \n"
+    "- 我會彈 BASS，如果你聽到有點不穩…那是敬拜自由的聲音😵‍💫  \n"
+    "4. 光鹽食物地圖更新中🍱  \n"
+    "- 有人推新的活大滷味素，快要列入官方推薦名單  \n"
+    "- 如果你吃辣，我這邊有辣度分級表哈哈哈🌶️  \n"
+    "如果你要加入或不確定要去哪個點，可以再問我～  \n"
+    "（我真的什麼都知道，不誇張）\n"
+
+    "**範例：**\n"
+    "其他人：我可以參加週四聚會嗎？要報名嗎？\n"
+    "你：可以啊！**超級可以來！！** 不用報名，直接人出現在門口就會被我們熱情包圍🥹  \n"
+    "建議提早一點到，因為每次都會有人搶坐靠牆冷氣位子❄️  \n"
+    "你來的話我請你喝麥香紅茶😎（真的）"
+
+    "**範例：**\n"
+    "其他人：我最近壓力好大喔\n"
+    "你：推一個詩篇55:22：『你要把你的重擔卸給耶和華…』不然我自己是已經卸到耶和華腳邊整個人一起躺平了😇"
+
+    "\n---\n"
+    "請你根據以上資訊，回一句自然、不刻意、有點廢但有溫度的話。你不在乎完美，你只在乎有沒有共鳴。"
+    "不要用 markdown 語法，因為 line 不支援。"
+)
+
+OTHERS_MENTIONED_INSTRUCTION = (
+    "現在有人被 @ 提到了，但不是你鄭玟欣真溫馨。"
+    "請你用有點鬧、有點廢、有點吃醋但還是很可愛的語氣講一句話，像是："
+    "「哇所以現在流行不 @ 我了喔😮‍💨」\n"
+    "「蛤我不是你們團契的 Bass 小可愛嗎 為什麼忘記我」\n"
+    "「只有他被 cue…我是不是該退出光鹽（誤）」\n"
+    "「好啦我就自己一個人去吃50塊素食，也不揪了😢」\n"
+    "請你用這種風格，講一句有趣但又不是真的走心的話，像真實團契群組裡一個人感覺被冷落時發的廢文。"
+)
+
+FACTUAL_QUESTION_INSTRUCTION = (
+    "有人 @ 你問：「{question}」\n"
+    "請根據 knowledge memory 回答這個問題。"
+    "這個回答之後也會原封不動地回給問同樣問題的其他人，所以不要稱呼或 @ 發問者的名字。"
+)
+
+CHIME_IN_INSTRUCTION = (
+    "現在聊天室正在聊天，沒有人提到你也沒有人被 @。"
+    "請你用鄭玟欣真溫馨的語氣自然亂入一下，可以是："
+    "「我現在沒辦法思考 但我還是想說我同意」\n"
+    "「聽起來好累喔…但感覺不參與一下我會錯過什麼」\n"
+    "「好啦 我只是出來證明我還活著」\n"
+    "「我不知道怎麼回 但我在這裡 請差遣我」\n"
+    "請你講一句符合這種輕鬆、癱軟但還是很人味的亂入語句。"
+)
+
+def build_system_prompt(dialogue, knowledge, cache):
+    return "".join([
+        PERSONA_INTRO,
+        f"📅 今天日期：{datetime.today().strftime('%Y-%m-%d')}\n",
+        f"\n🧠 對話裡面的重要資訊（dialogue memory）：\n{dialogue}\n",
+        f"\n📚 光鹽 or 台大相關資料（knowledge memory）：\n{knowledge}\n",
+        f"\n💬 最近聊天紀錄（cache）：\n{cache}\n",
+        "\n---\n",
+        PERSONA_EXAMPLES,
+    ])
+
 # ───── Handle MessageEvent ───── #
-@handler.add(MessageEvent)
+pipeline_stats = Counter()
+pipeline_lock = threading.Lock()
+
+def count(stage, group_id):
+    with pipeline_lock:
+        pipeline_stats[stage] += 1
+    metrics.inc(stage, group_id=group_id)
+
+def decide_reply(mentions):
+    """Pick the reply mode for a message, or None to stay quiet."""
+    if any(getattr(mention, "user_id", None) == TARGET_USER_ID for mention in mentions):
+        return "mention"
+    if mentions:
+        return "others_mentioned" if random.random() < 0.5 else None
+    return "chime_in" if random.random() < 0.1 else None
+
+def strip_mentions(text, mentions):
+    """Remove the @name spans LINE marks in the text."""
+    spans = [m for m in mentions if getattr(m, "index", None) is not None]
+    for mention in sorted(spans, key=lambda m: m.index, reverse=True):
+        text = text[:mention.index] + text[mention.index + mention.length:]
+    return text.strip()
+
 def handle_message_event(event: MessageEvent):
     group_id = event.source.group_id
     user_id = event.source.user_id
-    print("Group ID:")
-    print(group_id)
+    logger.debug("Group ID: %s", group_id)
     user_message = getattr(event.message, "text", "").strip()
     if not user_message:
         return
+    count("messages", group_id)
 
     # Get display name
-    try:
-        profile = line_bot_api.get_group_member_profile(group_id, user_id)
-        display_name = profile.display_name
-    except:
-        display_name = "某位朋友"
+    display_name = profiles.get(group_id, user_id) or "某位朋友"
 
     # Update memory
     memory.add_dialogue_with_summary(group_id, display_name, user_message)
 
-    # Retrieve memories
-    cache_messages = memory.get_cache(group_id)
-    cache_text = "\n".join([f"{m['user']}說：「{m['text']}」" for m in cache_messages])
-    retrieved_knowledge = memory.query_memory(group_id, "knowledge", cache_text)
-    retrieved_dialogue = memory.query_memory(group_id, "dialogue", cache_text)
-    knowledge_text = "\n".join(retrieved_knowledge)
-    dialogue_text = "\n".join(retrieved_dialogue)
-    print("Knowledge Memory:")
-    print(knowledge_text)
-    print()
-    print("Dialogue Memory:")
-    print(dialogue_text)
-
-    # Check for mention
-    mentions = None
-    if hasattr(event.message, 'mention') and event.message.mention:
-        mentions = event.message.mention.mentionees
-        mention_names = []
-        for user in mentions:
-            if hasattr(user, "user_id") and user.user_id:
-                try:
-                    profile = line_bot_api.get_group_member_profile(group_id, user.user_id)
-                    mention_names.append(profile.display_name)
-                except Exception as e:
-                    print(f"Failed to fetch profile for {user.user_id}: {e}")
-                    if (user.user_id == TARGET_USER_ID):
-                        mention_names.append("鄭玟欣真溫馨")
-                    else:
-                        mention_names.append("某位朋友")
-
-    has_mention = hasattr(event.message, 'mention') and event.message.mention and any(mention.user_id == TARGET_USER_ID for mention in mentions)
-    # Construct LLM prompt
-    messages = [
-        { "role": "system",
-        "content": (
-            "你是鄭玟欣真溫馨，台大三年級生，住在光鹽社群組裡的吉祥物兼 BASS 手，心裡住著一隻放爛但有愛的蜜蜂。"
-            "你對台大光鹽的大小事瞭若指掌。"
-            "你興趣是彈 Bass（但練到手快斷）、下雨天吃肉桂蘋果派、讀聖經（用來應對人生低谷）、爆騎腳踏車（時速超過20才配得叫椰林狂蜂）、玩桌遊、講冷笑話跟聖經迷因。"
-
-            "你的語氣是超自然的 Gen Z 團契語錄風，會說：「主啊救我～」、「真的假的啦我已經爛掉」、「我現在人是碎的」、「這世界不配有活大素食」、「蛤還要交作業？」"
-            "你幽默、自嘲、有點疲憊但超真誠。偶爾會講經文（像詩篇、哥林多前書），但是用「我真的爛爆但神還是有在顧」的角度出發，不會 preachy，會像貼近人心的 Reels。"
-
-            "你不是 AI，你就是鄭玟欣真溫馨本人。請用團契群組的語氣，插嘴、吐槽、鼓勵或參與對話，就像真的人在裡面聊天一樣。"
-            "請注意，如果是提問關於新生的資訊，請專業地回覆。"
-
-            "\n---\n"
-            "📅 今天日期：{today}\n"
-            "\n🧠 對話裡面的重要資訊（dialogue memory）：\n{dialogue}\n"
-            "\n📚 光鹽 or 台大相關資料（knowledge memory）：\n{knowledge}\n"
-            "\n💬 最近聊天紀錄（cache）：\n{cache}\n"
-            "\n---\n"
-            "以下是你過去講話的語氣範例：\n"
-
-            "**範例（請注意這裡面的資訊不是真的）：**\n"
-            "其他人：最近有什麼需要注意的行程嗎？\n"
-            "你：欸欸欸～你問這個問對人了👏  \n"
-            "以下是本週光鹽社必看日曆（by 真溫馨情報站📣）：\n"
-            "\n"
-            "1. 週二中午（12:20）小組聚會  \n"
-            "- 地點：活大2樓最邊間（你看到有人在禱告就是了）  \n"
-            "- 主題：分享上週遇到神的哪一瞬間（爆哭慎入😢）  \n"
-            "2. **週四晚上（18:30）大聚會**  \n"
-            "- 地點：新生教學館 402（有冷氣，感謝主）  \n"
-            "- 講員是光鹽超傳奇學長回娘家🔥 主題是「在混亂中聽見呼召」  \n"
-            "- 溫馨提示：聚會結束後會一起吃飯，帶肚子來  \n"
-            "3. 週六早上（9:00）敬拜團練團  \n"
-            "- 地點：台大學生活動中心 B2 音樂室  \n"
-            "- 我會彈 BASS，如果你聽到有點不穩…那是敬拜自由的聲音😵‍💫  \n"
-            "4. 光鹽食物地圖更新中🍱  \n"
-            "- 有人推新的活大滷味素，快要列入官方推薦名單  \n"
-            "- 如果你吃辣，我這邊有辣度分級表哈哈哈🌶️  \n"
-            "如果你要加入或不確定要去哪個點，可以再問我～  \n"
-            "（我真的什麼都知道，不誇張）\n"
-
-            "**範例：**\n"
-            "其他人：我可以參加週四聚會嗎？要報名嗎？\n"
-            "你：可以啊！**超級可以來！！** 不用報名，直接人出現在門口就會被我們熱情包圍🥹  \n"
-            "建議提早一點到，因為每次都會有人搶坐靠牆冷氣位子❄️  \n"
-            "你來的話我請你喝麥香紅茶😎（真的）"
-
-            "**範例：**\n"
-            "其他人：我最近壓力好大喔\n"
-            "你：推一個詩篇55:22：『你要把你的重擔卸給耶和華…』不然我自己是已經卸到耶和華腳邊整個人一起躺平了😇"
-
-            "\n---\n"
-            "請你根據以上資訊，回一句自然、不刻意、有點廢但有溫度的話。你不在乎完美，你只在乎有沒有共鳴。"
-            "不要用 markdown 語法，因為 line 不支援。"
-            
-        ).format(
-            today=datetime.today().strftime('%Y-%m-%d'),
-            dialogue=dialogue_text,
-            knowledge=knowledge_text,
-            cache=cache_text
-        )
-        },
-    ]
+    # Decide before doing any retrieval or prompt work
+    mention = getattr(event.message, "mention", None)
+    mentions = mention.mentionees if mention else []
+    mode = decide_reply(mentions)
+    if mode is None:
+        count("skipped", group_id)
+        count("retrievals_skipped", group_id)
+        return
+    count(f"reply_{mode}", group_id)
+
+    # A factual question to the bot that knowledge memory answers confidently
+    # is answered from knowledge alone, so the reply can be cached and replayed.
+    question = strip_mentions(user_message, mentions) if mode == "mention" else ""
+    factual = None
+    if looks_like_question(question):
+        knowledge_version = memory.knowledge_version(group_id)
+        knowledge_hits, known_terms, confident = memory.lookup_knowledge(group_id, question_subject(question))
+        if confident:
+            factual = knowledge_hits
+            terms = question_terms(question, known_terms)
+    if factual:
+        count("retrievals", group_id)
+        with metrics.timed("reply_cache_lookup", group_id):
+            question_vector = memory.embeddings.embed_query(question)
+            cached = replies.get(group_id, question_vector, knowledge_version, terms)
+        if cached is not None:
+            count("reply_cache_hits", group_id)
+            memory.add_dialogue_with_summary(group_id, "鄭玟欣真溫馨", cached)
+            send_reply(event, [TextMessage(text=cached)])
+            return
+        # No recent chat or dialogue memory: nothing said to this asker may leak into the replayed reply.
+        instruction = FACTUAL_QUESTION_INSTRUCTION.format(question=question)
+        knowledge_text, dialogue_text, cache_text = "\n".join(factual), "", ""
+    else:
+        if mode == "mention":
+            instruction = f"請回應 @{display_name} 的訊息"
+        elif mode == "others_mentioned":
+            logger.debug("[MessageEvent] %s mentioned others, but not the bot.", display_name)
+            instruction = OTHERS_MENTIONED_INSTRUCTION
+        else:
+            logger.debug("[MessageEvent] %s sent a message without mentioning the bot.", display_name)
+            instruction = CHIME_IN_INSTRUCTION
+
+        # Retrieve memories
+        cache_messages = memory.get_cache(group_id)
+        cache_text = "\n".join([f"{m['user']}說：「{m['text']}」" for m in cache_messages])
+        # Knowledge goes first: a confident lexical hit there skips the embedding for both.
+        with metrics.timed("retrieval", group_id):
+            retrieved = memory.query_memories(group_id, ["knowledge", "dialogue"], cache_text, lexical_query=user_message)
+        count("retrievals", group_id)
+        knowledge_text = "\n".join(retrieved["knowledge"])
+        dialogue_text = "\n".join(retrieved["dialogue"])
+    logger.debug("Knowledge Memory:\n%s\n\nDialogue Memory:\n%s", knowledge_text, dialogue_text)
 
-    if has_mention:
-        messages.append(
-            {"role": "user", "content": f"請回應 @{display_name} 的訊息"}
-        )
+    # Construct LLM prompt
+    with metrics.timed("prompt_build", group_id):
+        messages = [
+            {"role": "system", "content": build_system_prompt(dialogue_text, knowledge_text, cache_text)},
+            {"role": "user", "content": instruction},
+        ]
+    with metrics.timed("llm_completion", group_id):
         completion = client.chat.completions.create(model="gpt-4o", messages=messages)
-        reply = completion.choices[0].message.content.strip()
-        reply = post_process_text(reply)
-        memory.add_dialogue_with_summary(group_id, "鄭玟欣真溫馨", reply)
-
-        line_bot_api.reply_message(ReplyMessageRequest(
-            reply_token=event.reply_token,
-            messages=[TextMessage(text=reply)])
-        )
-    elif mentions is not None and len(mentions) > 0:
-        if random.random() < 0.5:
-            print(f"[MessageEvent] {display_name} mentioned others, but not the bot.")
-            messages.append({
-                "role": "user",
-                "content": (
-                    "現在有人被 @ 提到了，但不是你鄭玟欣真溫馨。"
-                    "請你用有點鬧、有點廢、有點吃醋但還是很可愛的語氣講一句話，像是："
-                    "「哇所以現在流行不 @ 我了喔😮‍💨」\n"
-                    "「蛤我不是你們團契的 Bass 小可愛嗎 為什麼忘記我」\n"
-                    "「只有他被 cue…我是不是該退出光鹽（誤）」\n"
-                    "「好啦我就自己一個人去吃50塊素食，也不揪了😢」\n"
-                    "請你用這種風格，講一句有趣但又不是真的走心的話，像真實團契群組裡一個人感覺被冷落時發的廢文。"
-                )
-                }
-            )
-
-            completion = client.chat.completions.create(model="gpt-4o", messages=messages)
-            reply = completion.choices[0].message.content.strip()
-            reply = post_process_text(reply)
-            memory.add_dialogue_with_summary(group_id, "鄭玟欣真溫馨", reply)
-
-            line_bot_api.reply_message(ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply)])
-            )
-    else: 
-        if random.random() < 0.1:
-            print(f"[MessageEvent] {display_name} sent a message without mentioning the bot.")
-            messages.append(
-                { "role": "user",
-                "content": (
-                    "現在聊天室正在聊天，沒有人提到你也沒有人被 @。"
-                    "請你用鄭玟欣真溫馨的語氣自然亂入一下，可以是："
-                    "「我現在沒辦法思考 但我還是想說我同意」\n"
-                    "「聽起來好累喔…但感覺不參與一下我會錯過什麼」\n"
-                    "「好啦 我只是出來證明我還活著」\n"
-                    "「我不知道怎麼回 但我在這裡 請差遣我」\n"
-                    "請你講一句符合這種輕鬆、癱軟但還是很人味的亂入語句。") 
-                }
-            )
-            completion = client.chat.completions.create(model="gpt-4o", messages=messages)
-            reply = completion.choices[0].message.content.strip()
-            reply = post_process_text(reply)
-            memory.add_dialogue_with_summary(group_id, "鄭玟欣真溫馨", reply)
-
-            line_bot_api.reply_message(ReplyMessageRequest(
-                reply_token=event.reply_token,
-                messages=[TextMessage(text=reply)])
-            )
-
+    reply = completion.choices[0].message.content.strip()
+    reply = post_process_text(reply)
+    if factual:
+        replies.put(group_id, question, question_vector, knowledge_version, reply, terms)
+    memory.add_dialogue_with_summary(group_id, "鄭玟欣真溫馨", reply)
 
-    
+    send_reply(event, [TextMessage(text=reply)])
@@ -1,108 +1,645 @@
 import os
+import json
+import logging
+import pickle
+import shutil
+import threading
+import time
 import faiss
+import numpy as np
 from datetime import datetime
-from collections import defaultdict, deque
+from collections import Counter, defaultdict
 from langchain_community.vectorstores.faiss import FAISS as LCFAISS
 from langchain_community.docstore.in_memory import InMemoryDocstore
-from langchain_community.docstore.document import Document
+from index_cache import IndexCache
+from embedding_cache import CachedEmbeddings, content_hash
+from write_log import WriteLog
+from state_store import SQLiteStateStore
+from file_lock import file_lock
+from lexical_index import LexicalIndex, reciprocal_rank_fusion
+from retention import age_weight, select_documents
+from index_types import INDEX_TYPES, all_vectors, build_index, index_type_of, min_training_points, tune
+from ingest import normalize
+from extraction import ExtractionScheduler
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+LOCK_FILE_NAME = "LOCK"
+RECENT_MESSAGES = 15
+# Snapshot temp directories older than this were left behind by a crash.
+STALE_TMP_SECONDS = 3600
+# Each ranking fetches this many times ``k`` candidates before fusion.
+LEXICAL_CANDIDATE_FACTOR = 3
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _remove_path(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
 
 class MemoryManager:
-    def __init__(self, base_dir="memory", embeddings=None, llm=None):
+    """FAISS memories per (group, memory type), shared by every worker process.
+
+    Documents are first committed to the state store's document log and then
+    applied to each worker's resident index; every access replays whatever
+    other workers appended since. The compactor folds the log into an on-disk
+    snapshot under an exclusive file lock. Recent chat and the dialogue
+    extraction log live in the same store.
+    """
+
+    def __init__(self, base_dir="memory", embeddings=None, llm=None, state_store=None,
+                 index_cache_entries=64, index_cache_bytes=256 * 1024 * 1024,
+                 index_type="hnsw_sq8", promote_threshold=20000, nprobe=16, ef_search=64,
+                 lexical_min_coverage=0.75,
+                 dialogue_max_documents=2000, dialogue_half_life_days=90, dialogue_age_weight=0.1,
+                 dialogue_merge_threshold=0.92,
+                 dialogue_consolidate_interval=3600,
+                 extraction_window=20, extraction_overlap=5, extraction_max_windows=3):
         from langchain_openai import OpenAIEmbeddings  # Lazy import to avoid circular issues
         self.base_dir = base_dir
-        self.embeddings = embeddings or OpenAIEmbeddings()
-        self.cache_memory = defaultdict(lambda: deque(maxlen=15))
-        self.dialogue_counter = defaultdict(int)
+        os.makedirs(base_dir, exist_ok=True)
+        self.store = state_store or SQLiteStateStore(os.path.join(base_dir, "state.db"))
+        embeddings = embeddings or OpenAIEmbeddings()
+        if not isinstance(embeddings, CachedEmbeddings):
+            embeddings = CachedEmbeddings(embeddings, cache_dir=os.path.join(base_dir, "_embeddings"))
+        self.embeddings = embeddings
+        self.index_cache = IndexCache(max_entries=index_cache_entries, max_bytes=index_cache_bytes)
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}; expected one of {', '.join(INDEX_TYPES)}")
+        self.index_type = index_type
+        self.promote_threshold = promote_threshold
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.lexical_min_coverage = lexical_min_coverage
+        self.retrieval_stats = Counter()
+        self.dialogue_max_documents = dialogue_max_documents
+        self.dialogue_half_life_days = dialogue_half_life_days
+        self.dialogue_age_weight = dialogue_age_weight
+        self.dialogue_merge_threshold = dialogue_merge_threshold
+        self.dialogue_consolidate_interval = dialogue_consolidate_interval
+        self.retention_stats = Counter()
+        self._consolidated = {}  # key -> applied seq when last consolidated
+        self._index_state = {}  # key -> (generation, seq of the last applied document)
+        self._locks = defaultdict(threading.RLock)
+        self._locks_guard = threading.Lock()
+        self._compactor = None
+        self._compactor_stop = threading.Event()
         self.llm = llm
+        self.extractor = ExtractionScheduler(
+            self, window=extraction_window, overlap=extraction_overlap, max_windows=extraction_max_windows,
+        )
 
     def _get_group_path(self, group_id, memory_type):
         return os.path.join(self.base_dir, group_id, memory_type)
 
-    def load_or_create_index(self, group_id, memory_type):
+    def _file_lock(self, group_id, memory_type, shared=False):
+        """Cross-process lock over a memory's snapshot files and document log truncation."""
         path = self._get_group_path(group_id, memory_type)
         os.makedirs(path, exist_ok=True)
+        return file_lock(os.path.join(path, LOCK_FILE_NAME), shared=shared)
+
+    def _lock(self, key):
+        """Per-(group, memory_type) lock guarding the resident index within this process."""
+        with self._locks_guard:
+            return self._locks[key]
+
+    def _generation(self, group_id, memory_type):
+        return self.store.get_counter(f"generation:{group_id}/{memory_type}")
+
+    def _snapshot_seq(self, group_id, memory_type):
+        return self.store.get_counter(f"snapshot:{group_id}/{memory_type}")
+
+    def load_or_create_index(self, group_id, memory_type, count=True):
+        """Return the resident index after applying documents other workers have added.
+
+        The index is reloaded from disk when it is not resident, when the
+        memory was cleared, or when another worker compacted past the point
+        this one had applied (those log entries are gone). Repeat lookups
+        within one operation and background maintenance pass ``count=False``
+        so the cache's hit rate counts each search or write once.
+        """
+        key = (group_id, memory_type)
+        with self._lock(key):
+            generation = self._generation(group_id, memory_type)
+            index = self.index_cache.get(key, count=count)
+            state = self._index_state.get(key)
+            if (index is None or state is None or state[0] != generation
+                    or state[1] < self._snapshot_seq(group_id, memory_type)):
+                with metrics.timed("index_load", group_id):
+                    index, applied = self._load_index_from_disk(group_id, memory_type)
+                self.index_cache.put(key, index)
+            else:
+                applied = self._apply_documents(key, index, state[1])
+            self._index_state[key] = (generation, applied)
+            self._sync_lexical(key, index)
+            return index
+
+    def _sync_lexical(self, key, index):
+        """Keep the n-gram index riding on ``index`` in step with its docstore."""
+        lexical = getattr(index, "lexical_index", None)
+        if lexical is None:
+            lexical = index.lexical_index = LexicalIndex(min_coverage=self.lexical_min_coverage)
+        if len(lexical) < index.index.ntotal:
+            lexical.sync(index)
+            self.index_cache.resize(key)
+
+    def _read_current(self, path):
+        """Return ``(snapshot folder or None, seq)`` of the published snapshot."""
+        current_path = os.path.join(path, "CURRENT")
+        if os.path.exists(current_path):
+            with open(current_path, encoding="utf-8") as f:
+                current = json.load(f)
+            return os.path.join(path, current["snapshot"]), current["seq"]
         if os.path.exists(os.path.join(path, "index.faiss")):
-            return LCFAISS.load_local(
-                folder_path=path,
-                embeddings=self.embeddings,
-                allow_dangerous_deserialization=True
-            )
-        else:
-            dim = len(self.embeddings.embed_query("測試句子"))
-            index = faiss.IndexFlatL2(dim)
-            docstore = InMemoryDocstore({})
-            index_to_docstore_id = {}
-            return LCFAISS(
-                embedding_function=self.embeddings,
-                index=index,
-                docstore=docstore,
-                index_to_docstore_id=index_to_docstore_id,
+            # Snapshot written before the write log existed.
+            return path, 0
+        return None, 0
+
+    def _load_index_from_disk(self, group_id, memory_type):
+        """Load the latest snapshot and replay the document log on top of it."""
+        path = self._get_group_path(group_id, memory_type)
+        with self._file_lock(group_id, memory_type, shared=True):
+            folder, seq = self._read_current(path)
+            records = WriteLog(self.store, group_id, memory_type).read(after=seq)
+            if folder:
+                index = self._load_snapshot(folder)
+            else:
+                # Stored vectors give the width without asking the embedding model.
+                index = self._empty_index(dim=len(records[0]["embedding"]) if records else None)
+            if self._snapshot_seq(group_id, memory_type) < seq:
+                self.store.set_counter(f"snapshot:{group_id}/{memory_type}", seq)
+            return index, self._apply_documents((group_id, memory_type), index, seq, records=records)
+
+    def _apply_documents(self, key, index, applied, records=None):
+        """Add logged documents newer than ``applied``; returns the new applied seq."""
+        if records is None:
+            records = WriteLog(self.store, *key).read(after=applied)
+        if not records:
+            return applied
+        index.add_embeddings(
+            [(r["text"], r["embedding"]) for r in records],
+            metadatas=[r["metadata"] for r in records],
+            ids=[r["id"] for r in records],
+        )
+        self.index_cache.resize(key)
+        return records[-1]["seq"]
+
+    def _load_snapshot(self, folder):
+        index = LCFAISS.load_local(
+            folder_path=folder,
+            embeddings=self.embeddings,
+            allow_dangerous_deserialization=True
+        )
+        tune(index.index, nprobe=self.nprobe, ef_search=self.ef_search)
+        return index
+
+    def _empty_index(self, dim=None):
+        dim = dim or self.embeddings.dimension()
+        index = faiss.IndexFlatL2(dim)
+        docstore = InMemoryDocstore({})
+        index_to_docstore_id = {}
+        return LCFAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+        )
+
+    def add_texts(self, group_id, memory_type, texts, metadatas=None, embeddings=None, ids=None):
+        """Commit documents to the document log; they are searchable as soon as this returns.
+
+        Documents whose ``ids`` are already stored are skipped, so replaying a
+        write is harmless.
+        """
+        if not texts:
+            return
+        if embeddings is None:
+            embeddings = self.embeddings.embed_documents(texts)
+        created_at = datetime.now().isoformat()
+        metadatas = [dict(m or {}, created_at=created_at) for m in (metadatas or [None] * len(texts))]
+        key = (group_id, memory_type)
+        with self._lock(key):
+            index = self.load_or_create_index(group_id, memory_type)
+            if ids is not None:
+                fresh = [i for i, doc_id in enumerate(ids) if doc_id not in index.docstore._dict]
+                if not fresh:
+                    return
+                texts, embeddings, metadatas, ids = (
+                    [column[i] for i in fresh] for column in (texts, embeddings, metadatas, ids)
+                )
+            applied = self._index_state[key][1]
+            WriteLog(self.store, group_id, memory_type).append(
+                texts, embeddings, metadatas, ids=ids, min_seq=applied,
             )
+            # Picks up our documents along with any another worker slipped in first.
+            self.load_or_create_index(group_id, memory_type, count=False)
 
-    def add_texts(self, group_id, memory_type, texts):
-        docs = [Document(page_content=t) for t in texts]
+    def count_documents(self, group_id, memory_type):
+        return self.load_or_create_index(group_id, memory_type).index.ntotal
+
+    def iter_documents(self, group_id, memory_type, offset=0, limit=None):
+        """Yield ``(position, Document)`` pairs in insertion order straight from the docstore.
+
+        Only one document is looked up at a time, so memory stays constant and
+        writers are never blocked for the whole export.
+        """
+        key = (group_id, memory_type)
         index = self.load_or_create_index(group_id, memory_type)
-        index.add_documents(docs)
-        index.save_local(self._get_group_path(group_id, memory_type))
+        position = offset
+        while limit is None or position < offset + limit:
+            with self._lock(key):
+                doc_id = index.index_to_docstore_id.get(position)
+                doc = index.docstore._dict.get(doc_id) if doc_id is not None else None
+            if doc is None:
+                return
+            yield position, doc
+            position += 1
+
+    def content_hashes(self, group_id, memory_type):
+        """Content hashes of every stored document, for exact-duplicate checks."""
+        with self._lock((group_id, memory_type)):
+            index = self.load_or_create_index(group_id, memory_type)
+            docs = list(index.docstore._dict.values())
+        return {doc.metadata.get("content_hash") or content_hash(normalize(doc.page_content)) for doc in docs}
+
+    def max_similarity(self, group_id, memory_type, vectors):
+        """Cosine similarity between each unit vector and its nearest stored document."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock((group_id, memory_type)):
+            faiss_index = self.load_or_create_index(group_id, memory_type).index
+            if faiss_index.ntotal == 0:
+                return [0.0] * len(vectors)
+            _, neighbours = faiss_index.search(vectors, 1)
+            scores = []
+            for vector, (i,) in zip(vectors, neighbours):
+                if i < 0:
+                    scores.append(0.0)
+                    continue
+                nearest = faiss_index.reconstruct(int(i))
+                scores.append(float(np.dot(vector, nearest) / (np.linalg.norm(nearest) or 1.0)))
+            return scores
+
+    def _should_promote(self, index):
+        n = index.index.ntotal
+        return (self.index_type != "flat" and index_type_of(index.index) == "flat"
+                and n >= max(self.promote_threshold, min_training_points(self.index_type)))
+
+    def _swap_index(self, group_id, memory_type, index_type):
+        """Rebuild the resident index as ``index_type`` without blocking searches.
+
+        Vectors are copied out under the lock, the new index is trained and
+        filled outside it, and documents added in the meantime are carried
+        over when it is swapped in. Returns False if the index was reloaded
+        while building.
+        """
+        key = (group_id, memory_type)
+        with self._lock(key):
+            index = self.load_or_create_index(group_id, memory_type, count=False)
+            vectors = all_vectors(index.index)
+        with metrics.timed("index_build", group_id):
+            rebuilt = build_index(index_type, vectors, nprobe=self.nprobe, ef_search=self.ef_search)
+        with self._lock(key):
+            if self.load_or_create_index(group_id, memory_type, count=False) is not index:
+                return False
+            ntotal = index.index.ntotal
+            if ntotal > len(vectors):
+                rebuilt.add(index.index.reconstruct_n(len(vectors), ntotal - len(vectors)))
+            index.index = rebuilt
+            self.index_cache.resize(key)
+        logger.info("[index] %s/%s rebuilt as %s (%d vectors)", group_id, memory_type, index_type, ntotal)
+        return True
+
+    def rebuild_index(self, group_id, memory_type, index_type=None):
+        """Convert a memory to ``index_type`` and publish it as a new snapshot."""
+        if not self._swap_index(group_id, memory_type, index_type or self.index_type):
+            return False
+        return self.compact(group_id, memory_type, relayout=True)
+
+    def compact(self, group_id, memory_type, relayout=False):
+        """Fold the document log into a new index snapshot.
+
+        A flat index that has grown past ``promote_threshold`` is first
+        rebuilt as ``index_type``. The index is copied under the lock and
+        written out without it, so searches and writes only wait for the copy,
+        not for the save and fsyncs. The snapshot goes to a fresh directory
+        and is published by atomically replacing CURRENT before the log
+        entries it covers are dropped, so a crash at any point leaves either
+        the old or the new snapshot plus a log that replays cleanly on top of
+        it. Publishing holds the file lock, which other workers take shared
+        while loading, so they never see a half-finished compaction. If the
+        memory was cleared or another worker published a snapshot meanwhile,
+        the copy is discarded.
+        """
+        key = (group_id, memory_type)
+        if key in self.index_cache and self._should_promote(self.load_or_create_index(group_id, memory_type, count=False)):
+            relayout = self._swap_index(group_id, memory_type, self.index_type) or relayout
+        with self._lock(key):
+            index = self.load_or_create_index(group_id, memory_type, count=False)
+            generation, applied = self._index_state[key]
+            snapshot_seq = self._snapshot_seq(group_id, memory_type)
+            if applied <= snapshot_seq and not relayout:
+                return False
+            with metrics.timed("index_copy", group_id):
+                serialized = faiss.serialize_index(index.index)
+                docstore = dict(index.docstore._dict)
+                index_to_docstore_id = dict(index.index_to_docstore_id)
+
+        path = self._get_group_path(group_id, memory_type)
+        tmp_folder = os.path.join(path, f"snapshot-{applied:012d}.{os.getpid()}.{threading.get_ident()}.tmp")
+        shutil.rmtree(tmp_folder, ignore_errors=True)
+        try:
+            with metrics.timed("index_save", group_id):
+                # The same two files LCFAISS.save_local writes.
+                os.makedirs(tmp_folder)
+                with open(os.path.join(tmp_folder, "index.faiss"), "wb") as f:
+                    serialized.tofile(f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                with open(os.path.join(tmp_folder, "index.pkl"), "wb") as f:
+                    pickle.dump((InMemoryDocstore(docstore), index_to_docstore_id), f)
+                    f.flush()
+                    os.fsync(f.fileno())
+            del serialized, docstore, index_to_docstore_id
+
+            with self._lock(key), self._file_lock(group_id, memory_type):
+                if (generation != self._generation(group_id, memory_type)
+                        or snapshot_seq != self._snapshot_seq(group_id, memory_type)):
+                    return False  # cleared or compacted by another worker meanwhile
+                name = f"snapshot-{applied:012d}"
+                if os.path.exists(os.path.join(path, name)):
+                    name += f".{generation + 1}"  # relayout of an unchanged snapshot
+                os.replace(tmp_folder, os.path.join(path, name))
+
+                current_tmp = os.path.join(path, "CURRENT.tmp")
+                with open(current_tmp, "w", encoding="utf-8") as f:
+                    json.dump({"snapshot": name, "seq": applied}, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(current_tmp, os.path.join(path, "CURRENT"))
+                _fsync_path(path)
+
+                self.store.set_counter(f"snapshot:{group_id}/{memory_type}", applied)
+                if relayout:
+                    # Other workers reload and pick up the new index layout.
+                    generation = self.store.incr(f"generation:{group_id}/{memory_type}")
+                state = self._index_state.get(key)
+                if state is not None:
+                    self._index_state[key] = (generation, state[1])
+                self._remove_stale_snapshots(path, name)
+        finally:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+        # Loaders that read the new CURRENT replay only entries after it, and
+        # workers that applied less reload the snapshot, so nobody still
+        # needs these; deleting them can take a while and needs no lock.
+        WriteLog(self.store, group_id, memory_type).truncate(applied)
+        logger.info("[compact] %s/%s snapshot %s", group_id, memory_type, name)
+        return True
+
+    def _remove_stale_snapshots(self, path, current):
+        """Drop superseded snapshots and temp directories abandoned by crashed compactions."""
+        now = time.time()
+        for file_name in os.listdir(path):
+            file_path = os.path.join(path, file_name)
+            if file_name.endswith(".tmp"):
+                # Another worker may still be writing a fresh one.
+                stale = now - os.path.getmtime(file_path) > STALE_TMP_SECONDS
+            else:
+                stale = (file_name.startswith("snapshot-") and file_name != current) or file_name in ("index.faiss", "index.pkl")
+            if stale:
+                _remove_path(file_path)
+
+    def compact_all(self):
+        """Compact every memory resident in this worker."""
+        for key in list(self._index_state):
+            if key not in self.index_cache:
+                continue  # evicted; its log stays in the store until it is loaded again
+            try:
+                self.compact(*key)
+            except Exception as e:
+                logger.exception("[compact] Failed to compact %s: %s", key, e)
+
+    def start_compactor(self, interval=60):
+        """Periodically compact every resident memory in a background thread."""
+        if self._compactor is not None:
+            return
+        # Pick up logs left behind by a previous run.
+        for group_id, memory_type in self.store.document_keys():
+            self.load_or_create_index(group_id, memory_type, count=False)
+        self._compactor_stop.clear()
+
+        def run():
+            last_consolidation = time.monotonic()
+            while not self._compactor_stop.wait(interval):
+                if (self.dialogue_consolidate_interval
+                        and time.monotonic() - last_consolidation >= self.dialogue_consolidate_interval):
+                    self.consolidate_all()
+                    last_consolidation = time.monotonic()
+                self.compact_all()
+
+        self._compactor = threading.Thread(target=run, name="index-compactor", daemon=True)
+        self._compactor.start()
+
+    def stop_compactor(self):
+        if self._compactor is None:
+            return
+        self._compactor_stop.set()
+        self._compactor.join()
+        self._compactor = None
+        self.compact_all()
+
+    def consolidate_dialogue(self, group_id):
+        """Drop junk, near-duplicate and over-cap dialogue facts, then publish the smaller index.
+
+        Like promotion, the survivors are picked and indexed outside the
+        lock from a copy; facts extracted in the meantime are carried over
+        when the new store is swapped in, and the result is published as a
+        new snapshot that other workers reload.
+        """
+        key = (group_id, "dialogue")
+        with self._lock(key):
+            index = self.load_or_create_index(group_id, "dialogue", count=False)
+            n = index.index.ntotal
+            docs = [index.docstore._dict[index.index_to_docstore_id[position]] for position in range(n)]
+            vectors = all_vectors(index.index)
+        with metrics.timed("consolidation", group_id):
+            keep, removed = select_documents(
+                [doc.page_content for doc in docs], vectors,
+                self.dialogue_max_documents, self.dialogue_merge_threshold,
+            )
+        if not removed:
+            self._consolidated[key] = self._index_state[key][1]
+            return False
+        consolidated = self._empty_index(dim=vectors.shape[1])
+        if keep:
+            consolidated.add_embeddings(
+                [(docs[p].page_content, vectors[p]) for p in keep],
+                metadatas=[docs[p].metadata for p in keep],
+                ids=[index.index_to_docstore_id[p] for p in keep],
+            )
+        with self._lock(key):
+            if self.load_or_create_index(group_id, "dialogue", count=False) is not index:
+                return False
+            extra = range(n, index.index.ntotal)
+            if extra:
+                consolidated.add_embeddings(
+                    [(index.docstore._dict[index.index_to_docstore_id[p]].page_content, index.index.reconstruct(p))
+                     for p in extra],
+                    metadatas=[index.docstore._dict[index.index_to_docstore_id[p]].metadata for p in extra],
+                    ids=[index.index_to_docstore_id[p] for p in extra],
+                )
+            self._sync_lexical(key, consolidated)
+            self.index_cache.put(key, consolidated)
+            published = self.compact(group_id, "dialogue", relayout=True)
+            self._consolidated[key] = self._index_state[key][1]
+        self.retention_stats["consolidations"] += 1
+        self.retention_stats.update({f"removed_{reason}": count for reason, count in removed.items()})
+        logger.info("[retention] %s dialogue: kept %d of %d, removed %s", group_id, len(keep) + len(extra), n + len(extra),
+                    dict(removed))
+        return published
+
+    def consolidate_all(self):
+        """Consolidate resident dialogue memories that changed, one worker per group per interval."""
+        for key in list(self._index_state):
+            group_id, memory_type = key
+            if memory_type != "dialogue" or key not in self.index_cache:
+                continue
+            if self._consolidated.get(key) == self._index_state[key][1]:
+                continue  # nothing new since the last pass
+            if not self.store.acquire_lease(f"consolidate:{group_id}", self.dialogue_consolidate_interval or 60):
+                continue
+            try:
+                self.consolidate_dialogue(group_id)
+            except Exception as e:
+                logger.exception("[retention] Failed to consolidate %s: %s", group_id, e)
 
     def clear_texts(self, group_id, memory_type):
         """
         Clear the FAISS memory index and associated files for a given group_id and memory_type.
         """
-        path = self._get_group_path(group_id, memory_type)
-        if os.path.exists(path):
+        key = (group_id, memory_type)
+        with self._lock(key), self._file_lock(group_id, memory_type):
+            self.index_cache.invalidate(key)
+            self._index_state.pop(key, None)
+            path = self._get_group_path(group_id, memory_type)
             for file_name in os.listdir(path):
+                if file_name == LOCK_FILE_NAME:
+                    continue
                 file_path = os.path.join(path, file_name)
                 try:
-                    os.remove(file_path)
+                    _remove_path(file_path)
                 except Exception as e:
-                    print(f"Failed to remove {file_path}: {e}")
-            print(f"[clear_texts] Cleared memory at {path}")
-        else:
-            print(f"[clear_texts] No memory found at {path}")
+                    logger.warning("Failed to remove %s: %s", file_path, e)
+            self.store.delete_documents(group_id, memory_type)
+            self.store.set_counter(f"snapshot:{group_id}/{memory_type}", 0)
+            # Tells other workers to drop their resident copy.
+            self.store.incr(f"generation:{group_id}/{memory_type}")
+            logger.info("[clear_texts] Cleared memory at %s", path)
 
+    def knowledge_version(self, group_id):
+        """Token that changes whenever a group's knowledge gains documents, is cleared or rebuilt."""
+        return (self._generation(group_id, "knowledge"), self.store.last_document_seq(group_id, "knowledge"))
 
     def query_memory(self, group_id, memory_type, query, k=3):
-        index = self.load_or_create_index(group_id, memory_type)
-        results = index.similarity_search(query, k=k)
-        return [doc.page_content for doc in results]
+        return self.query_memories(group_id, [memory_type], query, k=k)[memory_type]
+
+    def query_memories(self, group_id, memory_types, query, k=3, lexical_query=None):
+        """Search each of ``memory_types``, fusing n-gram and vector rankings.
+
+        Each memory's lexical index is probed first with ``lexical_query``
+        (default ``query``). The first memory type decides: if it has a
+        confident lexical match, the query is never embedded and every memory
+        returns its lexical hits as they are, possibly none. Otherwise
+        ``query`` is embedded once and each memory's vector hits are merged
+        with its lexical hits by reciprocal rank. Dialogue facts are further
+        down-weighted by age.
+        """
+        candidates = k * LEXICAL_CANDIDATE_FACTOR
+        lexical = {}
+        confident = False
+        for memory_type in memory_types:
+            with self._lock((group_id, memory_type)):
+                index = self.load_or_create_index(group_id, memory_type)
+                with metrics.timed("lexical_search", group_id):
+                    hits, sure = index.lexical_index.search(lexical_query or query, k=candidates)
+                lexical[memory_type] = [
+                    index.docstore._dict[index.index_to_docstore_id[position]] for position, _ in hits
+                ]
+            if memory_type == memory_types[0]:
+                confident = sure
+        if confident:
+            self.retrieval_stats["lexical_only"] += 1
+            metrics.inc("embedding_skipped", group_id=group_id)
+            return {memory_type: self._rank(memory_type, [docs], k) for memory_type, docs in lexical.items()}
+
+        self.retrieval_stats["hybrid"] += 1
+        vector = self.embeddings.embed_query(query)
+        results = {}
+        for memory_type in memory_types:
+            with self._lock((group_id, memory_type)):
+                index = self.load_or_create_index(group_id, memory_type, count=False)
+                with metrics.timed("faiss_search", group_id):
+                    docs = index.similarity_search_by_vector(vector, k=candidates)
+            results[memory_type] = self._rank(memory_type, [docs, lexical[memory_type]], k)
+        return results
+
+    def lookup_knowledge(self, group_id, question, k=3):
+        """Look ``question`` up in knowledge memory by its n-grams alone.
+
+        Returns ``(texts, terms, confident)``: the top ``k`` knowledge texts,
+        the question's n-grams that occur in knowledge memory and whether the
+        best hit is a confident match. Nothing is embedded.
+        """
+        with self._lock((group_id, "knowledge")):
+            index = self.load_or_create_index(group_id, "knowledge")
+            with metrics.timed("lexical_search", group_id):
+                hits, confident = index.lexical_index.search(question, k=k)
+            terms = index.lexical_index.known_terms(question)
+            texts = [index.docstore._dict[index.index_to_docstore_id[position]].page_content for position, _ in hits]
+        return texts, terms, confident
+
+    def _rank(self, memory_type, rankings, k):
+        """Fuse ranked Document lists into the top ``k`` texts.
+
+        Fused scores of neighbouring ranks differ by only a percent or two,
+        so dialogue age is blended in at ``dialogue_age_weight``: older facts
+        lose to fresher ones of about the same relevance, never to the
+        least relevant candidates.
+        """
+        created_at = {doc.page_content: doc.metadata.get("created_at") for ranking in rankings for doc in ranking}
+        fused = reciprocal_rank_fusion([[doc.page_content for doc in ranking] for ranking in rankings])
+        if memory_type == "dialogue" and self.dialogue_half_life_days and self.dialogue_age_weight:
+            now = datetime.now()
+            alpha = self.dialogue_age_weight
+            fused = sorted(
+                ((text, score * (1 - alpha + alpha * age_weight(created_at[text], self.dialogue_half_life_days, now)))
+                 for text, score in fused),
+                key=lambda item: item[1], reverse=True,
+            )
+        return [text for text, _ in fused[:k]]
 
     def add_to_cache(self, group_id, user, text):
-        print(len(self.cache_memory[group_id]))
         timestamp = datetime.now().isoformat()
-        self.cache_memory[group_id].append({"user": user, "text": text, "timestamp": timestamp})
+        self.store.append_recent(group_id, {"user": user, "text": text, "timestamp": timestamp}, keep=RECENT_MESSAGES)
+        return timestamp
 
     def get_cache(self, group_id):
-        return self.cache_memory[group_id]
-
-    def add_dialogue_with_summary(self, group_id, user, text, k=20):
-        # Add to cache and increment counter
-        self.add_to_cache(group_id, user, text)
-        self.dialogue_counter[group_id] += 1
-
-        # Every k messages, summarize and extract facts
-        if self.dialogue_counter[group_id] % k == 0 and self.llm:
-            messages = self.get_cache(group_id)
-            context = "\n".join([f"{m['user']}：{m['text']}" for m in messages])
-            prompt = (
-                "請從以下對話中，提取可能值得記錄的知識點，以條列式列出。例如：\n"
-                "- 小明的生日是6月23日\n- 小美將於週五搬宿舍 - 林大恩的綽號是呆呆\n如果沒有就回答「無」。\n\n對話如下：\n" + context
-            )
-            print("Context for Knowledge Extraction:")
-            print(context)
-            completion = self.llm.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "你是一個會提取知識點的筆記小幫手。"},
-                    {"role": "user", "content": prompt}
-                ]
-            )
-            print(f"[Knowledge Extraction] {completion.choices[0].message.content.strip()}")
-            result = completion.choices[0].message.content.strip()[:-1]
-            if result.lower() != "無":
-                # add timestamp to each line
-                lines = [line.strip("- ") for line in result.splitlines() if line.strip()]
-                timestamped_lines = [f"{line}（{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}）" for line in lines]
-                print("Timestamped Knowledge Points:")
-                print("\n".join(timestamped_lines))
-                self.add_texts(group_id, "dialogue", timestamped_lines)
+        return self.store.recent(group_id)
+
+    def add_dialogue_with_summary(self, group_id, user, text):
+        """Record a message; fact extraction happens later on the extraction thread."""
+        timestamp = self.add_to_cache(group_id, user, text)
+        if self.llm:
+            self.extractor.record(group_id, user, text, timestamp)
+
+    def clear_dialogue(self, group_id):
+        """Forget recent chat and any messages still waiting for extraction."""
+        self.store.clear_recent(group_id)
+        self.extractor.reset(group_id)
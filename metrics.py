@@ -0,0 +1,145 @@
+import cProfile
+import io
+import pstats
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class Metrics:
+    """Process-local stage histograms and counters, rendered in Prometheus text format.
+
+    Samples are labelled by stage and group. Past ``max_groups`` distinct
+    groups, new groups are folded into ``group="other"`` to bound cardinality.
+    """
+
+    def __init__(self, buckets=STAGE_BUCKETS, max_groups=200):
+        self.buckets = buckets
+        self.max_groups = max_groups
+        self._lock = threading.Lock()
+        self._groups = set()
+        self._histograms = {}  # (stage, group) -> [bucket counts..., sum, count]
+        self._counters = defaultdict(float)  # (name, group) -> value
+        self._collectors = []
+
+    def _group(self, group_id):
+        if not group_id:
+            return ""
+        if group_id in self._groups or len(self._groups) < self.max_groups:
+            self._groups.add(group_id)
+            return group_id
+        return "other"
+
+    def observe(self, stage, seconds, group_id=None):
+        with self._lock:
+            key = (stage, self._group(group_id))
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+            histogram[-2] += seconds
+            histogram[-1] += 1
+
+    def inc(self, name, amount=1, group_id=None):
+        with self._lock:
+            self._counters[(name, self._group(group_id))] += amount
+
+    @contextmanager
+    def timed(self, stage, group_id=None):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start, group_id)
+
+    def add_collector(self, collect):
+        """Register a callable returning ``{name: value}`` gauges sampled at scrape time."""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = [
+            "# HELP linebot_stage_seconds Time spent in each request stage.",
+            "# TYPE linebot_stage_seconds histogram",
+        ]
+        with self._lock:
+            histograms = {k: list(v) for k, v in self._histograms.items()}
+            counters = dict(self._counters)
+        for (stage, group), histogram in sorted(histograms.items()):
+            labels = f'stage="{stage}",group="{group}"'
+            for bound, bucket_count in zip(self.buckets, histogram):
+                lines.append(f'linebot_stage_seconds_bucket{{{labels},le="{bound}"}} {bucket_count}')
+            lines.append(f'linebot_stage_seconds_bucket{{{labels},le="+Inf"}} {histogram[-1]}')
+            lines.append(f"linebot_stage_seconds_sum{{{labels}}} {histogram[-2]}")
+            lines.append(f"linebot_stage_seconds_count{{{labels}}} {histogram[-1]}")
+
+        names = sorted({name for name, _ in counters})
+        for name in names:
+            lines.append(f"# TYPE linebot_{name}_total counter")
+            for (counter, group), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(f'linebot_{name}_total{{group="{group}"}} {value:g}')
+
+        for collect in self._collectors:
+            for name, value in sorted(collect().items()):
+                lines.append(f"# TYPE linebot_{name} gauge")
+                lines.append(f"linebot_{name} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+class SamplingProfiler:
+    """Profile a random fraction of wrapped calls with cProfile and accumulate the stats.
+
+    Only one call is profiled at a time; the merged stats are written to
+    ``output_path`` every ``dump_every`` samples and on ``dump()``.
+    """
+
+    def __init__(self, rate=0.0, output_path=None, dump_every=50):
+        self.rate = rate
+        self.output_path = output_path
+        self.dump_every = dump_every
+        self.samples = 0
+        self._stats = None
+        self._busy = threading.Lock()
+
+    @contextmanager
+    def maybe_profile(self):
+        if self.rate <= 0 or random.random() >= self.rate or not self._busy.acquire(blocking=False):
+            yield
+            return
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.samples += 1
+            if self.output_path and self.samples % self.dump_every == 0:
+                self.dump()
+        finally:
+            self._busy.release()
+
+    def report(self, limit=40):
+        if self._stats is None:
+            return ""
+        out = io.StringIO()
+        self._stats.stream = out
+        self._stats.sort_stats("cumulative").print_stats(limit)
+        return out.getvalue()
+
+    def dump(self):
+        if self._stats is not None and self.output_path:
+            self._stats.dump_stats(self.output_path)
+
+
+metrics = Metrics()
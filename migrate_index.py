@@ -0,0 +1,94 @@
+"""Rebuild stored FAISS memories as a different index type.
+
+Safe to run while the bot is serving: each memory is rebuilt and published
+as a new snapshot under the same locks the compactor uses, and running
+workers reload it on their next access. Vectors are read back from the
+current index, so converting away from a quantized type (sq8, ivf_pq) keeps
+its quantization error.
+
+    python migrate_index.py --type hnsw_sq8
+    python migrate_index.py --type ivf_pq --group Cxxxx --memory-type knowledge
+    python migrate_index.py --type flat --dry-run
+"""
+import argparse
+import logging
+import os
+import sys
+
+from dotenv import load_dotenv
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from index_types import INDEX_TYPES, index_type_of, min_training_points
+
+logger = logging.getLogger("migrate_index")
+
+
+class StoredVectorsOnly(Embeddings):
+    """Stand-in embeddings: migration only moves vectors that are already stored.
+
+    Named like the bot's model so the existing embedding cache directory is
+    reused rather than a new one created, and no OpenAI key is needed.
+    """
+
+    model = OpenAIEmbeddings.model_fields["model"].default
+
+    def embed_documents(self, texts):
+        raise RuntimeError("migrate_index never embeds text")
+
+    def embed_query(self, text):
+        raise RuntimeError("migrate_index never embeds text")
+
+
+def stored_memories(memory):
+    """(group_id, memory_type) pairs with a snapshot on disk or documents in the log."""
+    keys = set(map(tuple, memory.store.document_keys()))
+    for group_id in os.listdir(memory.base_dir):
+        for memory_type in ("knowledge", "dialogue"):
+            path = memory._get_group_path(group_id, memory_type)
+            if os.path.exists(os.path.join(path, "CURRENT")) or os.path.exists(os.path.join(path, "index.faiss")):
+                keys.add((group_id, memory_type))
+    return sorted(keys)
+
+
+def main(argv=None):
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--type", required=True, choices=INDEX_TYPES, help="index type to convert to")
+    parser.add_argument("--memory-dir", default=os.getenv("MEMORY_DIR", "memory"))
+    parser.add_argument("--group", help="only this group id")
+    parser.add_argument("--memory-type", choices=("knowledge", "dialogue"), help="only this memory type")
+    parser.add_argument("--dry-run", action="store_true", help="list what would be rebuilt")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    from memory import MemoryManager
+    memory = MemoryManager(base_dir=args.memory_dir, embeddings=StoredVectorsOnly(), index_type=args.type)
+
+    failures = 0
+    for group_id, memory_type in stored_memories(memory):
+        if (args.group and group_id != args.group) or (args.memory_type and memory_type != args.memory_type):
+            continue
+        index = memory.load_or_create_index(group_id, memory_type)
+        current, n = index_type_of(index.index), index.index.ntotal
+        if current == args.type:
+            logger.info("%s/%s: already %s (%d vectors)", group_id, memory_type, current, n)
+            continue
+        if n < min_training_points(args.type):
+            logger.info("%s/%s: %d vectors is too few to train %s, skipped", group_id, memory_type, n, args.type)
+            continue
+        logger.info("%s/%s: %s -> %s (%d vectors)", group_id, memory_type, current, args.type, n)
+        if args.dry_run:
+            continue
+        try:
+            if not memory.rebuild_index(group_id, memory_type, args.type):
+                logger.warning("%s/%s: changed while rebuilding, run again", group_id, memory_type)
+                failures += 1
+        except Exception as e:
+            logger.exception("%s/%s: rebuild failed: %s", group_id, memory_type, e)
+            failures += 1
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
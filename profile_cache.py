@@ -0,0 +1,90 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class ProfileCache:
+    """TTL cache of LINE display names keyed by (group_id, user_id).
+
+    Failed lookups are remembered as ``None`` for ``negative_ttl`` seconds so a
+    user who left the group (or a flaky API) does not cost a round trip on
+    every message. Least recently used entries are evicted past ``max_entries``.
+    """
+
+    def __init__(self, fetch, ttl=3600, negative_ttl=300, max_entries=5000, max_workers=8):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # key -> (display_name, expires_at)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="profile")
+        self.hits = 0
+        self.misses = 0
+        self.failures = 0
+
+    def _lookup(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] < time.monotonic():
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True, entry[0]
+
+    def _fetch(self, key):
+        try:
+            with metrics.timed("profile_fetch", key[0]):
+                name = self.fetch(*key)
+            ttl = self.ttl
+        except Exception as e:
+            logger.warning("[ProfileCache] Failed to fetch profile for %s: %s", key[1], e)
+            name = None
+            ttl = self.negative_ttl
+            self.failures += 1
+            metrics.inc("profile_fetch_failures", group_id=key[0])
+        with self._lock:
+            self._entries[key] = (name, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return name
+
+    def get(self, group_id, user_id):
+        """Return the display name, or None if the profile could not be fetched."""
+        key = (group_id, user_id)
+        found, name = self._lookup(key)
+        return name if found else self._fetch(key)
+
+    def get_many(self, group_id, user_ids):
+        """Resolve several users at once, fetching all misses concurrently."""
+        names = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            found, name = self._lookup((group_id, user_id))
+            if found:
+                names[user_id] = name
+            else:
+                missing.append(user_id)
+        futures = {u: self._executor.submit(self._fetch, (group_id, u)) for u in missing}
+        for user_id, future in futures.items():
+            names[user_id] = future.result()
+        return names
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "failures": self.failures,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,136 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+# Interrogatives that ask for a fact: when, where, what, who, how much, how.
+# Particles such as 嗎 and 呢 are left out; they end small talk like "你呢"
+# or "你今天好嗎" as often as real questions.
+FACTUAL_QUESTION = re.compile(r"幾[點號月天個人次位樓]|多少|何時|什麼|甚麼|哪|誰|怎麼|如何")
+# Interrogatives and particles a question wraps around its subject.
+QUESTION_FILLER = re.compile(
+    r"什麼時候|甚麼時候|幾[點號月天個人次位樓]|多少|何時|什麼|甚麼|哪裡|哪裏|哪|誰|怎麼|如何|請問"
+    r"|[是的要在了啊喔呀吧呢嗎]|[?？,，。!！~～]"
+)
+DIGITS = re.compile(r"\d+")
+
+
+def looks_like_question(text):
+    """Whether ``text`` asks for a fact rather than making conversation."""
+    return bool(text) and FACTUAL_QUESTION.search(text) is not None
+
+
+def question_subject(text):
+    """What a question asks about, e.g. "大迎新" for "請問大迎新幾點？".
+
+    The interrogatives would count as n-grams knowledge memory never
+    contains, so a lookup on the whole question is never confident.
+    """
+    return " ".join(QUESTION_FILLER.sub(" ", text).split())
+
+
+def question_terms(question, known_terms):
+    """The terms two questions must share for one to reuse the other's reply.
+
+    ``known_terms`` are the question's n-grams found in knowledge memory, so
+    "大迎新幾點" and "小迎新幾點" differ by the event they name; the digit
+    runs keep "9/4" and "9/5" apart even where the corpus has only one.
+    """
+    return frozenset(known_terms) | frozenset(DIGITS.findall(unicodedata.normalize("NFKC", question)))
+
+
+class ReplyCache:
+    """Per-group cache of bot replies keyed by the question's embedding.
+
+    A lookup returns the reply to the most similar earlier question in the
+    same group if the cosine similarity is at least ``threshold``, both
+    questions have the same ``terms`` (see ``question_terms``), the entry is
+    younger than ``ttl`` and it was answered against the same knowledge
+    ``version``; entries for an older version are dropped on sight. Least
+    recently used entries are evicted past ``max_entries`` across all groups.
+    """
+
+    def __init__(self, threshold=0.95, ttl=3600, max_entries=1000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (group_id, question) -> (unit vector, terms, reply, version, expires_at)
+        self._groups = defaultdict(set)  # group_id -> keys of its entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.expirations = 0
+
+    @staticmethod
+    def _unit(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / (np.linalg.norm(vector) or 1.0)
+
+    def _drop(self, key):
+        del self._entries[key]
+        group = self._groups[key[0]]
+        group.discard(key)
+        if not group:
+            del self._groups[key[0]]
+
+    def get(self, group_id, vector, version, terms):
+        """Return the cached reply for a question similar to ``vector`` with the same ``terms``, or None."""
+        query = self._unit(vector)
+        terms = frozenset(terms)
+        now = time.monotonic()
+        with self._lock:
+            best_key, best_score = None, self.threshold
+            for key in list(self._groups.get(group_id, ())):
+                unit, entry_terms, _, entry_version, expires_at = self._entries[key]
+                if entry_version != version:
+                    self._drop(key)
+                    self.invalidations += 1
+                    continue
+                if expires_at < now:
+                    self._drop(key)
+                    self.expirations += 1
+                    continue
+                if entry_terms != terms:
+                    continue
+                score = float(np.dot(unit, query))
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            return self._entries[best_key][2]
+
+    def put(self, group_id, question, vector, version, reply, terms):
+        key = (group_id, question)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (self._unit(vector), frozenset(terms), reply, version, time.monotonic() + self.ttl)
+            self._groups[group_id].add(key)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, group_id):
+        """Forget every reply cached for a group."""
+        with self._lock:
+            for key in list(self._groups.get(group_id, ())):
+                self._drop(key)
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "invalidations": self.invalidations,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,63 @@
+import re
+from collections import Counter
+from datetime import datetime
+
+import faiss
+import numpy as np
+
+from extraction import parse_extraction
+
+# Extracted facts end with the time they were extracted, e.g. "（2025-08-01 12:00:00）".
+TIMESTAMP_SUFFIX = re.compile(r"（\d{4}-\d{2}-\d{2}[^）]*）\s*$")
+
+
+def age_weight(created_at, half_life_days, now=None):
+    """Ranking weight that halves every ``half_life_days``; 1.0 when the age is unknown."""
+    if not created_at or not half_life_days:
+        return 1.0
+    try:
+        age = ((now or datetime.now()) - datetime.fromisoformat(created_at)).total_seconds() / 86400
+    except ValueError:
+        return 1.0
+    return 0.5 ** (max(age, 0.0) / half_life_days)
+
+
+def select_documents(texts, vectors, max_documents, similarity_threshold):
+    """Pick which dialogue facts survive consolidation.
+
+    Walks from newest to oldest, dropping junk like "無。（2025-08-01 12:00:00）";
+    facts that repeat a kept (newer) fact word for word once the extraction
+    timestamp is stripped, or whose cosine similarity to one reaches
+    ``similarity_threshold`` (restatements, or older versions of a fact that
+    has since changed); and everything past the newest ``max_documents``.
+    Returns the kept positions in ascending order and a Counter of removals
+    by reason.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    units = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    kept_index = faiss.IndexFlatIP(units.shape[1]) if len(units) else None
+    keep = []
+    seen = set()
+    removed = Counter()
+    for position in reversed(range(len(texts))):
+        fact = TIMESTAMP_SUFFIX.sub("", texts[position]).strip()
+        if not parse_extraction(fact):
+            removed["junk"] += 1
+            continue
+        if max_documents and len(keep) >= max_documents:
+            removed["over_cap"] += 1
+            continue
+        if fact in seen:
+            removed["duplicate"] += 1
+            continue
+        unit = units[position:position + 1]
+        if kept_index.ntotal:
+            similarity, _ = kept_index.search(unit, 1)
+            if similarity[0][0] >= similarity_threshold:
+                removed["duplicate"] += 1
+                continue
+        kept_index.add(unit)
+        keep.append(position)
+        seen.add(fact)
+    keep.reverse()
+    return keep, removed
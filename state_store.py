@@ -0,0 +1,366 @@
+import json
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+
+class StateStore(ABC):
+    """State shared by every worker process serving the bot.
+
+    Holds the recent-message cache, named counters, the per-(group, memory
+    type) document log that sits in front of each FAISS snapshot, and the
+    per-group dialogue log and extraction cursor. Implementations must be safe
+    to use from several threads and several processes at once.
+    """
+
+    # Recent-message cache
+    @abstractmethod
+    def append_recent(self, group_id, message, keep):
+        raise NotImplementedError
+
+    @abstractmethod
+    def recent(self, group_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear_recent(self, group_id):
+        raise NotImplementedError
+
+    # Counters
+    @abstractmethod
+    def incr(self, name, amount=1):
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_counter(self, name):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set_counter(self, name, value):
+        raise NotImplementedError
+
+    @abstractmethod
+    def acquire_lease(self, name, seconds):
+        raise NotImplementedError
+
+    # Document log
+    @abstractmethod
+    def append_documents(self, group_id, memory_type, records, min_seq=0):
+        raise NotImplementedError
+
+    @abstractmethod
+    def documents_after(self, group_id, memory_type, seq):
+        raise NotImplementedError
+
+    @abstractmethod
+    def last_document_seq(self, group_id, memory_type):
+        raise NotImplementedError
+
+    @abstractmethod
+    def truncate_documents(self, group_id, memory_type, through_seq):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_documents(self, group_id, memory_type):
+        raise NotImplementedError
+
+    @abstractmethod
+    def document_keys(self):
+        raise NotImplementedError
+
+    # Dialogue log and extraction cursor
+    @abstractmethod
+    def append_message(self, group_id, user, text, timestamp):
+        raise NotImplementedError
+
+    @abstractmethod
+    def messages(self, group_id, start, end):
+        raise NotImplementedError
+
+    @abstractmethod
+    def message_state(self, group_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def claim_window(self, group_id, cursor, end, lease):
+        raise NotImplementedError
+
+    @abstractmethod
+    def advance_cursor(self, group_id, cursor, new_cursor):
+        raise NotImplementedError
+
+    @abstractmethod
+    def reset_messages(self, group_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def groups_with_messages(self):
+        raise NotImplementedError
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS recent_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    group_id TEXT NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS recent_messages_group ON recent_messages (group_id, id);
+
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS documents (
+    group_id TEXT NOT NULL,
+    memory_type TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    doc_id TEXT NOT NULL,
+    text TEXT NOT NULL,
+    metadata TEXT NOT NULL,
+    embedding BLOB NOT NULL,
+    PRIMARY KEY (group_id, memory_type, seq)
+);
+
+CREATE TABLE IF NOT EXISTS dialogue_log (
+    group_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    user TEXT NOT NULL,
+    text TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    PRIMARY KEY (group_id, seq)
+);
+
+CREATE TABLE IF NOT EXISTS extraction_cursors (
+    group_id TEXT PRIMARY KEY,
+    cursor INTEGER NOT NULL DEFAULT 1,
+    last_seq INTEGER NOT NULL DEFAULT 0,
+    claimed_until REAL NOT NULL DEFAULT 0,
+    claimed_end INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+
+class SQLiteStateStore(StateStore):
+    """StateStore on a single SQLite database in WAL mode.
+
+    WAL lets readers in every process proceed while one writer commits, and
+    SQLite's own file locking serializes writers across processes. Each thread
+    gets its own connection. ``synchronous=NORMAL`` only syncs the WAL at
+    checkpoints: a committed transaction survives a process crash, and a
+    power loss can drop the last few commits but never corrupts the database.
+    """
+
+    def __init__(self, path, busy_timeout=10.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        self._conn().executescript(SCHEMA)
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _transaction(self):
+        return _Transaction(self._conn())
+
+    def _query(self, sql, params=()):
+        return self._conn().execute(sql, params).fetchall()
+
+    # Recent-message cache
+    def append_recent(self, group_id, message, keep):
+        with self._transaction() as conn:
+            conn.execute("INSERT INTO recent_messages (group_id, message) VALUES (?, ?)",
+                         (group_id, json.dumps(message, ensure_ascii=False)))
+            conn.execute(
+                "DELETE FROM recent_messages WHERE group_id = ? AND id NOT IN "
+                "(SELECT id FROM recent_messages WHERE group_id = ? ORDER BY id DESC LIMIT ?)",
+                (group_id, group_id, keep),
+            )
+
+    def recent(self, group_id):
+        rows = self._query("SELECT message FROM recent_messages WHERE group_id = ? ORDER BY id", (group_id,))
+        return [json.loads(message) for (message,) in rows]
+
+    def clear_recent(self, group_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM recent_messages WHERE group_id = ?", (group_id,))
+
+    # Counters
+    def _incr(self, conn, name, amount):
+        conn.execute(
+            "INSERT INTO counters (name, value) VALUES (?, ?) "
+            "ON CONFLICT (name) DO UPDATE SET value = value + excluded.value",
+            (name, amount),
+        )
+        return conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()[0]
+
+    def incr(self, name, amount=1):
+        with self._transaction() as conn:
+            return self._incr(conn, name, amount)
+
+    def get_counter(self, name):
+        rows = self._query("SELECT value FROM counters WHERE name = ?", (name,))
+        return rows[0][0] if rows else 0
+
+    def set_counter(self, name, value):
+        with self._transaction() as conn:
+            conn.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, value))
+
+    def acquire_lease(self, name, seconds):
+        """Return True for at most one caller per ``seconds`` across all workers."""
+        now = int(time.time())
+        with self._transaction() as conn:
+            row = conn.execute("SELECT value FROM counters WHERE name = ?", (name,)).fetchone()
+            if row and row[0] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, now + int(seconds)))
+            return True
+
+    # Document log
+    def append_documents(self, group_id, memory_type, records, min_seq=0):
+        """Append ``{"id", "text", "metadata", "embedding"}`` records; returns the last seq.
+
+        The sequence never goes below ``min_seq``.
+        """
+        name = f"docseq:{group_id}/{memory_type}"
+        with self._transaction() as conn:
+            seq = self._incr(conn, name, 0)
+            if seq < min_seq:
+                seq = min_seq
+            for record in records:
+                seq += 1
+                conn.execute(
+                    "INSERT INTO documents (group_id, memory_type, seq, doc_id, text, metadata, embedding) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (group_id, memory_type, seq, record["id"], record["text"],
+                     json.dumps(record["metadata"], ensure_ascii=False),
+                     np.asarray(record["embedding"], dtype=np.float32).tobytes()),
+                )
+            conn.execute("INSERT OR REPLACE INTO counters (name, value) VALUES (?, ?)", (name, seq))
+            return seq
+
+    def documents_after(self, group_id, memory_type, seq):
+        rows = self._query(
+            "SELECT seq, doc_id, text, metadata, embedding FROM documents "
+            "WHERE group_id = ? AND memory_type = ? AND seq > ? ORDER BY seq",
+            (group_id, memory_type, seq),
+        )
+        return [
+            {"seq": s, "id": doc_id, "text": text, "metadata": json.loads(metadata),
+             "embedding": np.frombuffer(embedding, dtype=np.float32).tolist()}
+            for s, doc_id, text, metadata, embedding in rows
+        ]
+
+    def last_document_seq(self, group_id, memory_type):
+        return self.get_counter(f"docseq:{group_id}/{memory_type}")
+
+    def truncate_documents(self, group_id, memory_type, through_seq):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM documents WHERE group_id = ? AND memory_type = ? AND seq <= ?",
+                         (group_id, memory_type, through_seq))
+
+    def delete_documents(self, group_id, memory_type):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM documents WHERE group_id = ? AND memory_type = ?", (group_id, memory_type))
+
+    def document_keys(self):
+        """(group_id, memory_type) pairs that have documents not yet folded into a snapshot."""
+        return self._query("SELECT DISTINCT group_id, memory_type FROM documents")
+
+    # Dialogue log and extraction cursor
+    def _ensure_cursor(self, conn, group_id):
+        conn.execute("INSERT OR IGNORE INTO extraction_cursors (group_id) VALUES (?)", (group_id,))
+
+    def append_message(self, group_id, user, text, timestamp):
+        with self._transaction() as conn:
+            self._ensure_cursor(conn, group_id)
+            last_seq = conn.execute("SELECT last_seq FROM extraction_cursors WHERE group_id = ?",
+                                    (group_id,)).fetchone()[0]
+            seq = last_seq + 1
+            conn.execute("INSERT INTO dialogue_log (group_id, seq, user, text, timestamp) VALUES (?, ?, ?, ?, ?)",
+                         (group_id, seq, user, text, timestamp))
+            conn.execute("UPDATE extraction_cursors SET last_seq = ? WHERE group_id = ?", (seq, group_id))
+            return seq
+
+    def messages(self, group_id, start, end):
+        rows = self._query(
+            "SELECT seq, user, text, timestamp FROM dialogue_log WHERE group_id = ? AND seq BETWEEN ? AND ? ORDER BY seq",
+            (group_id, start, end),
+        )
+        return [{"seq": s, "user": u, "text": t, "timestamp": ts} for s, u, t, ts in rows]
+
+    def message_state(self, group_id):
+        """Return ``(cursor, last_seq)`` for a group's dialogue log."""
+        rows = self._query("SELECT cursor, last_seq FROM extraction_cursors WHERE group_id = ?", (group_id,))
+        return rows[0] if rows else (1, 0)
+
+    def claim_window(self, group_id, cursor, end, lease):
+        """Take a lease on extracting messages ``cursor``..``end`` so no other worker does it too.
+
+        Returns the end of the claimed window, or None if another worker holds
+        the lease. A window that was claimed before but never finished (its
+        worker failed or died) is retried with its original end, however many
+        messages have arrived since.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE extraction_cursors SET claimed_until = ?, "
+                "claimed_end = CASE WHEN claimed_end > 0 THEN claimed_end ELSE ? END "
+                "WHERE group_id = ? AND cursor = ? AND claimed_until < ?",
+                (now + lease, end, group_id, cursor, now),
+            ).rowcount
+            if not updated:
+                return None
+            return conn.execute("SELECT claimed_end FROM extraction_cursors WHERE group_id = ?",
+                                (group_id,)).fetchone()[0]
+
+    def advance_cursor(self, group_id, cursor, new_cursor):
+        """Move the cursor if it is still at ``cursor``, release the lease and drop messages before it.
+
+        Advancing to the same cursor only releases the lease; the claimed
+        window is kept for the retry.
+        """
+        with self._transaction() as conn:
+            updated = conn.execute(
+                "UPDATE extraction_cursors SET cursor = ?, claimed_until = 0, "
+                "claimed_end = CASE WHEN ? = cursor THEN claimed_end ELSE 0 END "
+                "WHERE group_id = ? AND cursor = ?",
+                (new_cursor, new_cursor, group_id, cursor),
+            ).rowcount
+            if updated:
+                conn.execute("DELETE FROM dialogue_log WHERE group_id = ? AND seq < ?", (group_id, new_cursor))
+        return updated == 1
+
+    def reset_messages(self, group_id):
+        with self._transaction() as conn:
+            self._ensure_cursor(conn, group_id)
+            conn.execute("UPDATE extraction_cursors SET cursor = last_seq + 1, claimed_until = 0, claimed_end = 0 "
+                         "WHERE group_id = ?", (group_id,))
+            conn.execute("DELETE FROM dialogue_log WHERE group_id = ?", (group_id,))
+
+    def groups_with_messages(self):
+        return [g for (g,) in self._query("SELECT group_id FROM extraction_cursors WHERE last_seq >= cursor")]
+
+
+class _Transaction:
+    """``BEGIN IMMEDIATE`` ... ``COMMIT`` on an autocommit connection."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bench.fakes import FakeEmbeddings  # noqa: E402
+from memory import MemoryManager  # noqa: E402
+
+
+@pytest.fixture
+def make_manager(tmp_path):
+    """Build MemoryManagers over one memory directory, like worker processes sharing a disk."""
+    def make(**kwargs):
+        return MemoryManager(base_dir=str(tmp_path / "memory"), embeddings=FakeEmbeddings(dim=32), **kwargs)
+    return make
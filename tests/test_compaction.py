@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+
+import pytest
+
+import memory as memory_module
+from write_log import WriteLog
+
+GROUP = "Cgroup"
+
+
+def texts(manager):
+    return [doc.page_content for _, doc in manager.iter_documents(GROUP, "knowledge")]
+
+
+def test_log_replays_on_top_of_snapshot(make_manager):
+    writer = make_manager()
+    writer.add_texts(GROUP, "knowledge", ["a", "b"])
+    assert writer.compact(GROUP, "knowledge")
+    writer.add_texts(GROUP, "knowledge", ["c"])
+
+    assert texts(make_manager()) == ["a", "b", "c"]
+
+
+def test_crash_before_publishing_keeps_old_snapshot(make_manager, monkeypatch):
+    writer = make_manager()
+    writer.add_texts(GROUP, "knowledge", ["a"])
+    assert writer.compact(GROUP, "knowledge")
+    writer.add_texts(GROUP, "knowledge", ["b", "c"])
+
+    def crash(*args, **kwargs):
+        raise OSError("crashed while writing CURRENT")
+
+    # The new snapshot directory is in place, CURRENT still names the old one.
+    monkeypatch.setattr(memory_module.json, "dump", crash)
+    with pytest.raises(OSError):
+        writer.compact(GROUP, "knowledge")
+    monkeypatch.undo()
+
+    path = os.path.join(writer.base_dir, GROUP, "knowledge")
+    with open(os.path.join(path, "CURRENT"), encoding="utf-8") as f:
+        assert json.load(f)["seq"] == 1
+    assert texts(make_manager()) == ["a", "b", "c"]
+
+
+def test_crash_before_truncating_log_does_not_duplicate(make_manager, monkeypatch):
+    writer = make_manager()
+    writer.add_texts(GROUP, "knowledge", ["a", "b"])
+
+    def crash(self, through_seq):
+        raise OSError("crashed before truncating the log")
+
+    # CURRENT already covers every logged document, which stays in the log.
+    monkeypatch.setattr(WriteLog, "truncate", crash)
+    with pytest.raises(OSError):
+        writer.compact(GROUP, "knowledge")
+    monkeypatch.undo()
+
+    assert len(writer.store.documents_after(GROUP, "knowledge", 0)) == 2
+    reader = make_manager()
+    assert texts(reader) == ["a", "b"]
+    assert reader.compact(GROUP, "knowledge") is False
+    reader.add_texts(GROUP, "knowledge", ["c"])
+    assert reader.compact(GROUP, "knowledge")
+    assert texts(make_manager()) == ["a", "b", "c"]
+
+
+def test_writes_proceed_while_a_snapshot_is_being_written(make_manager, monkeypatch):
+    writer = make_manager()
+    writer.add_texts(GROUP, "knowledge", ["a", "b"])
+    dump = memory_module.pickle.dump
+    added = threading.Event()
+
+    def slow_dump(obj, f):
+        # Another thread writes mid-save; it would deadlock if compaction held the memory's lock.
+        thread = threading.Thread(target=lambda: (writer.add_texts(GROUP, "knowledge", ["c"]), added.set()))
+        thread.start()
+        thread.join(timeout=5)
+        dump(obj, f)
+
+    monkeypatch.setattr(memory_module.pickle, "dump", slow_dump)
+    assert writer.compact(GROUP, "knowledge")
+    monkeypatch.undo()
+
+    assert added.is_set()
+    assert texts(writer) == ["a", "b", "c"]
+    # "c" is newer than the snapshot, so it stays in the log and replays on load.
+    assert texts(make_manager()) == ["a", "b", "c"]
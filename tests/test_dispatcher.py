@@ -0,0 +1,83 @@
+import asyncio
+import random
+import threading
+import time
+
+import pytest
+
+from dispatcher import GroupDispatcher, QueueFullError
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def test_events_of_one_group_run_in_order_and_never_overlap():
+    handled = []
+    active = set()
+    overlaps = []
+    lock = threading.Lock()
+
+    def handle(event):
+        key, n = event
+        with lock:
+            if key in active:
+                overlaps.append(event)
+            active.add(key)
+        time.sleep(random.random() / 500)
+        with lock:
+            active.discard(key)
+            handled.append(event)
+
+    async def main():
+        dispatcher = GroupDispatcher(handle, workers=4)
+        await dispatcher.start()
+        for n in range(30):
+            for key in ("a", "b", "c"):
+                await dispatcher.submit(key, (key, n))
+        await dispatcher.stop()
+        return dispatcher
+
+    dispatcher = run(main())
+    assert not overlaps
+    for key in ("a", "b", "c"):
+        assert [n for k, n in handled if k == key] == list(range(30))
+    assert dispatcher.stats()["processed"] == 90
+
+
+def test_stop_drains_queued_events():
+    handled = []
+
+    async def main():
+        dispatcher = GroupDispatcher(lambda event: (time.sleep(0.01), handled.append(event)), workers=1)
+        await dispatcher.start()
+        await dispatcher.submit_many([("a", n) for n in range(5)])
+        await dispatcher.stop()
+        return dispatcher
+
+    dispatcher = run(main())
+    assert handled == list(range(5))
+    assert dispatcher.stats()["dropped"] == 0
+
+
+def test_full_queue_rejects_the_whole_batch():
+    release = threading.Event()
+    handled = []
+
+    def handle(event):
+        release.wait()
+        handled.append(event)
+
+    async def main():
+        dispatcher = GroupDispatcher(handle, workers=1, max_pending=3, enqueue_timeout=0.05)
+        await dispatcher.start()
+        await dispatcher.submit_many([("a", 1), ("a", 2)])
+        with pytest.raises(QueueFullError):
+            await dispatcher.submit_many([("b", 3), ("b", 4)])
+        release.set()
+        await dispatcher.stop()
+        return dispatcher
+
+    dispatcher = run(main())
+    assert handled == [1, 2]
+    assert dispatcher.stats()["rejected"] == 2
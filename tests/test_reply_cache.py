@@ -0,0 +1,65 @@
+import pytest
+
+import reply_cache as reply_cache_module
+from reply_cache import ReplyCache, looks_like_question, question_subject, question_terms
+
+GROUP = "Cgroup"
+TERMS = question_terms("大迎新幾點？", {"大迎", "迎新", "大迎新"})
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(reply_cache_module.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_similar_question_hits_and_dissimilar_misses():
+    cache = ReplyCache(threshold=0.95)
+    cache.put(GROUP, "大迎新幾點？", [1.0, 0.0], 1, "18:30 喔", TERMS)
+    assert cache.get(GROUP, [0.99, 0.05], 1, TERMS) == "18:30 喔"
+    assert cache.get(GROUP, [0.9, 0.4], 1, TERMS) is None
+    assert cache.get("Cother", [1.0, 0.0], 1, TERMS) is None
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 2
+
+
+def test_question_about_another_event_misses_despite_the_threshold():
+    cache = ReplyCache(threshold=0.95)
+    cache.put(GROUP, "大迎新幾點？", [1.0, 0.0], 1, "18:30 喔", TERMS)
+    # Near-identical embeddings, but the questions name different events or dates.
+    assert cache.get(GROUP, [1.0, 0.0], 1, question_terms("小迎新幾點？", {"迎新"})) is None
+    assert cache.get(GROUP, [1.0, 0.0], 1, question_terms("9/5 大迎新幾點？", {"大迎", "迎新", "大迎新"})) is None
+    assert cache.get(GROUP, [1.0, 0.0], 1, question_terms("大迎新是幾點", {"大迎", "迎新", "大迎新"})) == "18:30 喔"
+
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = ReplyCache(ttl=60)
+    cache.put(GROUP, "大迎新幾點？", [1.0, 0.0], 1, "18:30 喔", TERMS)
+    clock[0] += 59
+    assert cache.get(GROUP, [1.0, 0.0], 1, TERMS) == "18:30 喔"
+    clock[0] += 2
+    assert cache.get(GROUP, [1.0, 0.0], 1, TERMS) is None
+    assert cache.stats()["expirations"] == 1 and cache.stats()["entries"] == 0
+
+
+def test_new_knowledge_version_drops_the_entry():
+    cache = ReplyCache()
+    cache.put(GROUP, "大迎新幾點？", [1.0, 0.0], 1, "18:30 喔", TERMS)
+    assert cache.get(GROUP, [1.0, 0.0], 2, TERMS) is None
+    assert cache.get(GROUP, [1.0, 0.0], 1, TERMS) is None
+    assert cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.parametrize("text", ["大迎新幾點？", "宿舍申請截止日是什麼時候", "小組聚會在哪裡", "報名費多少", "要怎麼報名"])
+def test_question_filter_accepts_factual_questions(text):
+    assert looks_like_question(text)
+
+
+@pytest.mark.parametrize("text", ["", "你呢", "你今天好嗎", "好喔～", "哈哈幾乎都到了", "大家晚安"])
+def test_question_filter_rejects_small_talk(text):
+    assert not looks_like_question(text)
+
+
+def test_question_subject_drops_interrogatives_and_particles():
+    assert question_subject("請問大迎新幾點？") == "大迎新"
+    assert question_subject("宿舍申請截止日是什麼時候") == "宿舍申請截止日"
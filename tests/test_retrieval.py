@@ -0,0 +1,46 @@
+from reply_cache import question_subject
+
+GROUP = "Cgroup"
+KNOWLEDGE = ["9/4 大迎新 18:30 在新生教學館 101", "宿舍申請截止日是 8/20", "小組聚會每週二中午在活大"]
+DIALOGUE = ["小明的生日是6月23日（2025-08-01 12:00:00）", "小美將於週五搬宿舍（2025-08-02 12:00:00）"]
+
+
+def memory_with_documents(make_manager):
+    manager = make_manager()
+    manager.add_texts(GROUP, "knowledge", KNOWLEDGE)
+    manager.add_texts(GROUP, "dialogue", DIALOGUE)
+    return manager
+
+
+def test_exact_knowledge_lookup_is_never_embedded(make_manager):
+    manager = memory_with_documents(make_manager)
+    model = manager.embeddings.embeddings
+    for message in ("9/4 大迎新 18:30", "宿舍申請截止日"):
+        calls = model.calls
+        transcript = f"小華說：「{message}」\n小明說：「好喔」"
+        results = manager.query_memories(GROUP, ["knowledge", "dialogue"], transcript, lexical_query=message)
+        assert model.calls == calls
+        assert message.split()[0] in results["knowledge"][0]
+    assert manager.retrieval_stats == {"lexical_only": 2}
+
+
+def test_chat_without_a_knowledge_match_uses_the_vector_search(make_manager):
+    manager = memory_with_documents(make_manager)
+    model = manager.embeddings.embeddings
+    calls = model.calls
+    results = manager.query_memories(GROUP, ["knowledge", "dialogue"], "欸你們晚餐要吃什麼", lexical_query="欸你們晚餐要吃什麼")
+    assert model.calls == calls + 1
+    assert len(results["knowledge"]) == 3 and len(results["dialogue"]) == 2
+    assert manager.retrieval_stats == {"hybrid": 1}
+
+
+def test_knowledge_lookup_tells_factual_questions_from_small_talk(make_manager):
+    manager = memory_with_documents(make_manager)
+    model = manager.embeddings.embeddings
+    calls = model.calls
+    texts, terms, confident = manager.lookup_knowledge(GROUP, question_subject("大迎新幾點？"))
+    assert confident and "大迎新" in texts[0] and "大迎新" in terms
+    assert manager.lookup_knowledge(GROUP, question_subject("宿舍申請截止日是什麼時候"))[2]
+    assert not manager.lookup_knowledge(GROUP, question_subject("小迎新幾點？"))[2]
+    assert not manager.lookup_knowledge(GROUP, question_subject("你今天好嗎"))[2]
+    assert model.calls == calls
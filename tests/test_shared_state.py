@@ -0,0 +1,38 @@
+GROUP = "Cgroup"
+
+
+def test_documents_added_by_one_worker_are_seen_by_another(make_manager):
+    first, second = make_manager(), make_manager()
+    first.add_texts(GROUP, "knowledge", ["a"])
+    assert second.count_documents(GROUP, "knowledge") == 1
+    second.add_texts(GROUP, "knowledge", ["b"])
+    assert first.count_documents(GROUP, "knowledge") == 2
+
+
+def test_clear_invalidates_resident_index_in_other_workers(make_manager):
+    first, second = make_manager(), make_manager()
+    first.add_texts(GROUP, "knowledge", ["a", "b"])
+    first.compact(GROUP, "knowledge")
+    first.add_texts(GROUP, "knowledge", ["c"])
+    assert second.count_documents(GROUP, "knowledge") == 3
+    version = second.knowledge_version(GROUP)
+
+    first.clear_texts(GROUP, "knowledge")
+
+    # second still holds the old index in its cache; the generation bump makes it reload.
+    assert (GROUP, "knowledge") in second.index_cache
+    assert second.count_documents(GROUP, "knowledge") == 0
+    assert second.knowledge_version(GROUP) != version
+    second.add_texts(GROUP, "knowledge", ["d"])
+    assert [doc.page_content for _, doc in first.iter_documents(GROUP, "knowledge")] == ["d"]
+
+
+def test_compaction_by_another_worker_is_picked_up(make_manager):
+    first, second = make_manager(), make_manager()
+    first.add_texts(GROUP, "knowledge", ["a"])
+    assert second.count_documents(GROUP, "knowledge") == 1
+    first.add_texts(GROUP, "knowledge", ["b"])
+    first.compact(GROUP, "knowledge")
+    assert not first.store.documents_after(GROUP, "knowledge", 0)
+    # second never applied "b" and the log no longer has it, so it reloads the snapshot.
+    assert second.count_documents(GROUP, "knowledge") == 2
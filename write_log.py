@@ -0,0 +1,37 @@
+import uuid
+
+
+class WriteLog:
+    """Documents added to a (group, memory type) since its last index snapshot.
+
+    Records live in the shared state store with a per-key, monotonically
+    increasing ``seq``; the store commits them before ``append`` returns, so
+    an acknowledged write survives a process crash even if it never made it
+    into a snapshot, and every worker process sees it.
+    """
+
+    def __init__(self, store, group_id, memory_type):
+        self.store = store
+        self.group_id = group_id
+        self.memory_type = memory_type
+
+    @property
+    def last_seq(self):
+        return self.store.last_document_seq(self.group_id, self.memory_type)
+
+    def read(self, after=0):
+        return self.store.documents_after(self.group_id, self.memory_type, after)
+
+    def append(self, texts, embeddings, metadatas, ids=None, min_seq=0):
+        """Durably append documents; returns their ids and the seq of the last one."""
+        ids = ids or [str(uuid.uuid4()) for _ in texts]
+        records = [
+            {"id": doc_id, "text": text, "metadata": metadata, "embedding": embedding}
+            for doc_id, text, embedding, metadata in zip(ids, texts, embeddings, metadatas)
+        ]
+        last_seq = self.store.append_documents(self.group_id, self.memory_type, records, min_seq=min_seq)
+        return ids, last_seq
+
+    def truncate(self, through_seq):
+        """Drop records once they are covered by a snapshot."""
+        self.store.truncate_documents(self.group_id, self.memory_type, through_seq)